@@ -17,41 +17,33 @@ parser.add_argument('--host', action='store',
                     help='start host', default='localhost')
 parser.add_argument('--port', '-p', action='store',
                     type=int, help='start post', default=5000)
+cli_args = parser.parse_args()
 
 import logging
-logging.basicConfig(level=parser.parse_args().logging_level.upper(), format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+logging.basicConfig(level=cli_args.logging_level.upper(), format='%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 logging.info('Importing...')
 
-from typing import Optional
 import json
-import random
+import queue
 
-import numpy as np
-
-from pyngrok import ngrok
-if parser.parse_args().env:
+if cli_args.env:
     logging.info('load env values...')
     from dotenv import load_dotenv
-    if load_dotenv(parser.parse_args().env):
-        logging.info(f'load `{parser.parse_args().env}` success.')
+    if load_dotenv(cli_args.env):
+        logging.info(f'load `{cli_args.env}` success.')
     else:
         logging.warning('no .env file has load.')
 
-import time
-import matplotlib.pyplot as plt
-import requests
-
-import io
-import base64
-from PIL import Image
-
-from flask import Flask, request, jsonify, render_template, redirect, send_file
+from flask import Flask, Response, request, jsonify, render_template, redirect, send_file
 
 import util
-import line
+import cache
+import models
+import pipeline
+import jobs
 logging.info('Import done.')
 
-app = util.app
+app = Flask(__name__)
 
 @app.route('/')
 def index():
@@ -59,15 +51,33 @@ def index():
 
 @app.route('/style_example/<img_name>')
 def style_example(img_name):
-    return send_file(f'./static/style_example/{img_name}')
+    return send_file(util.STYLE_EXAMPLE_DIR + img_name, max_age=3600)
+
+@app.route('/ready')
+def ready():
+    """
+    :return:
+        load state of every model. 503 until all models are loaded.
+    """
+    status = models.registry.status()
+    is_ready = all(v['state'] == 'loaded' for v in status.values())
+    return jsonify({
+        'ready': is_ready,
+        'models': status
+    }), 200 if is_ready else 503
 
 @app.route('/analysis')
 def analysis():
-    style_list = list(util.config["prompt_style"].keys())
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    probabilities = util.style_sampler.probabilities()
+    style_list = list(probabilities.keys())
     for i, s in enumerate(style_list):
         if len(s) > 25:
             style_list[i] = s[:10] + ' ... ' + s[-10:]
-    weight = util.softmax(np.array([v['random_weight'] for v in util.config["prompt_style"].values()]))
+    weight = list(probabilities.values())
     # Figure Size
     fig, ax = plt.subplots(figsize=(16, 9))
 
@@ -115,6 +125,10 @@ def raspberrypi_url():
     util.save_config("raspberrypi_server", request.values['raspberrypi_url'])
     return redirect('/')
 
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    return jsonify({name: c.stats() for name, c in cache.caches.items()})
+
 @app.route('/reload', methods=['GET'])
 def reload_config():
     util.load_config()
@@ -137,202 +151,161 @@ def comment():
 
     with open(path, 'r') as f:
         prompt_style = json.loads(f.read())['now_prompt_style']
-    try:
-        util.config['prompt_style'][prompt_style]["random_weight"] += score
-        logging.info(f'{prompt_style}, {util.config["prompt_style"][prompt_style]["random_weight"]}')
-        util.save_config()
-    except:
+    weight = util.config_store.add_rating(prompt_style, score)
+    if weight is not None:
+        logging.info(f'{prompt_style}, {weight}')
+    else:
         logging.warning(f'No prompt style \"{prompt_style}\"')
 
     return jsonify({
         k: util.config["prompt_style"][k]['random_weight'] for k in util.config["prompt_style"].keys()
     })
 
+def generate_args() -> dict:
+    """
+    Read `/generate` args from json body, multipart form (`img` and `voice` as files), or raw image bytes body.
+    Url params are always included.
+    """
+    args = request.args.to_dict()
+    if request.is_json:
+        args.update(request.json)
+    elif request.mimetype in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        args.update(request.form.to_dict())
+        for name, file in request.files.items():
+            args[name] = file.read()
+    else:
+        args['img'] = request.get_data()
+    return args
+
 @app.route('/generate', methods=['POST'])
 def generate():
     """
-    http body json args:
+    http body can be json, multipart form with `img` and `voice` as files, or raw image bytes.
+    args:
         img: image warp by raw base64 text,
-        voice: mp3 or wav file warp by raw base64 text
+        voice: mp3 or wav file warp by raw base64 text,
+        seed: (optional) MusicGen seed. same prompt and seed will reuse the cached bgm,
+        music_model, whisper_model: (optional) model variant for this request, must be in `model_pool.variants`,
+        response: (optional) `url` to return `img` and `bgm` as `url`, `content_type` and `size` instead of base64.
     :return:
         a json include `generated bgm`, `generated picture`, and `generated picture's comment and description`.
     """
-    args = request.json
-    img = args.get('img')
     try:
-        Image.open(io.BytesIO(base64.b64decode(img))).save(util.IMG_INPUT)
-    except:
-        return jsonify({'detail':'need img as input!'}), 400
-    voice_prompt: Optional[str] = args.get('voice', None)
-    image_prompt: str = args.get('image_prompt', '')
-    bgm_prompt: str = args.get('bgm_prompt', '')
-
-    style = None
-    if image_prompt == '' and bgm_prompt == '' and util.config['now_prompt_style'] is not None:
-        if util.config['now_prompt_style'] == util.RANDOM_PROMPT_STYLE:
-            logging.info('use prompt style: ' + util.config['now_prompt_style'])
-            style_list = list(util.config["prompt_style"].keys())
-            weight = util.softmax(np.array([v['random_weight'] for v in util.config["prompt_style"].values()])).tolist()
-            style = random.choices(style_list, weight)[0]
-            logging.info('random prompt style: ' + style)
-        else:
-            style = util.config['now_prompt_style']
-            if style in util.config['prompt_style']:
-                logging.info('use prompt style: ' + util.config['now_prompt_style'])
-            else:
-                logging.info(f'Not find `{util.config["now_prompt_style"]}` prompt style.')
-        try:
-            image_prompt = util.config["prompt_style"][style]['image_prompt']
-        except:
-            logging.info(f'Not find `image_prompt` in `{style}` prompt style.')
-        try:
-            bgm_prompt = util.config["prompt_style"][style]['bgm_prompt']
-        except:
-            logging.info(f'Not find `bgm_prompt` in `{style}` prompt style.')
-
-    if voice_prompt is not None:
-        with open(util.VOICE_PROMPT, 'wb') as f:
-            logging.info('save ' + util.VOICE_PROMPT)
-            f.write(base64.b64decode(voice_prompt))
-        voice_prompt = util.whisper_model.transcribe(util.VOICE_PROMPT, task='translate')["text"]
-        logging.info('transcribe voice: ' + voice_prompt)
-    else:
-        voice_prompt = ''
-
-    interrogate_img_prompt: str = ''
-    if util.config['image_generate_api'].lower() in util.IMAGE_GENERATE_API['sd']:
-        logging.info('interrogate image prompt...')
-        t1 = time.time()
-        interrogate_img_prompt = requests.post("http://127.0.0.1:7860/sdapi/v1/interrogate", json={
-            "image": img,
-            "model": "clip"
-        }).json()['caption']
-        logging.info('interrogate image prompt done. take {:.2f} sec.'.format(time.time() - t1))
-        image_generate_pipline = util.stable_diffusion_pipline
-    elif util.config['image_generate_api'].lower() in util.IMAGE_GENERATE_API['dall-e']:
-        image_generate_pipline = util.DALL_E_pipline
-    else:
-        return jsonify({
-            'detail': f'set config.json `image_generate_api` as {util.IMAGE_GENERATE_API}'
-        }), 400
-    logging.info(f'Image api: {image_generate_pipline.__name__}')
+        return jsonify(pipeline.generate(generate_args()))
+    except pipeline.PipelineError as e:
+        return jsonify({'detail': e.detail}), e.status_code
 
+@app.route('/generate/jobs', methods=['POST'])
+def submit_generate_job():
+    """
+    Same http body as `/generate`, but return a job id immediately.
+    :return:
+        202 with `job_id`, or 429 if the job queue is full.
+    """
     try:
-        gpt4_reply = util.GPT4_pipline(img, voice_prompt)
-    except RuntimeError as e:
-        logging.error(e.args[0], e)
-        return jsonify({
-            'detail': e.args[0]
-        }), 400
-
-    if voice_prompt == '':
-        voice_prompt = None
-    logging.info('gpt4_reply: ' + str(gpt4_reply))
-
-
-    img = image_generate_pipline(image_prompt + interrogate_img_prompt + gpt4_reply["img_prompt"],
-                                  img)
-
-    if isinstance(img, tuple):
-        logging.error(img[1][0], str(img[1]))
-        return jsonify({'detail': str(img[1])}), 400
-
-    bgm = util.music_gen_pipline(bgm_prompt + ('"' + voice_prompt + '", ' if voice_prompt is not None else '') + gpt4_reply["bgm_prompt"],
-                           util.VOICE_PROMPT if voice_prompt is not None else None)
+        job = jobs.pool.submit(pipeline.generate, generate_args())
+    except jobs.JobQueueFull as e:
+        return jsonify({'detail': str(e)}), 429
+    return jsonify(job.to_json()), 202
 
-    logging.info('GPT4 commenting...')
-    pic_comment = util.GPT4_pipline(img)
-    logging.info('GPT4 comment: ' + pic_comment)
+@app.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    """
+    Same http body as `/generate`, but response is a `text/event-stream`.
+    Events are `queued`, `transcription`, `prompts`, `image`, `bgm`, `comment`, then `done` or `error`.
+    """
+    events = queue.Queue()
 
-    logging.info('Logging generate result...')
-    time_stmp = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime(time.time()))
-    log_path = f'./static/log/{time_stmp}/'
+    def run(args: dict):
+        try:
+            result = pipeline.generate(args, lambda event, data: events.put((event, data)))
+        except Exception as e:
+            events.put(('error', {'detail': getattr(e, 'detail', str(e))}))
+            raise
+        events.put(('done', {k: result[k] for k in ('img_comment', 'time_stmp', 'info')}))
+        return result
 
     try:
-        os.makedirs(log_path)
-    except:
-        i = 1
+        job = jobs.pool.submit(run, generate_args())
+    except jobs.JobQueueFull as e:
+        return jsonify({'detail': str(e)}), 429
+
+    def stream():
+        yield f'event: queued\ndata: {json.dumps(job.to_json())}\n\n'
         while True:
             try:
-                time_stmp += f'({i})'
-                os.makedirs(log_path)
+                event, data = events.get(timeout=15)
+            except queue.Empty:
+                yield ': keep-alive\n\n'
+                continue
+            yield f'event: {event}\ndata: {json.dumps(data)}\n\n'
+            if event in ('done', 'error'):
                 break
-            except:
-                i += 1
 
-    def log(name: str):
-        try:
-            with open(name, 'rb') as l:
-                with open(log_path + name.split('/')[-1], 'wb') as f:
-                    f.write(l.read())
-        except FileNotFoundError:
-            pass
-
-    log(util.VOICE_PROMPT)
-    log(util.IMG_INPUT)
-    log(util.IMG_OUTPUT)
-    log(util.BGM_OUTPUT)
-    log(util.IMG_OUTPUT_PREVIEW)
-    log(util.BGM_OUTPUT[:-4] + '.mp3')
-    info_json = {
-        'img_prompt': image_prompt + interrogate_img_prompt + gpt4_reply["img_prompt"],
-        'bgm_prompt': bgm_prompt + ('"' + voice_prompt + '", ' if voice_prompt is not None else '') + gpt4_reply["bgm_prompt"],
-        'now_prompt_style': util.config['now_prompt_style'],
-        "prompt_style": style,
-    }
-    with open(log_path + 'info.json', 'w') as f:
-        f.write(json.dumps(info_json, indent=2))
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
+@app.route('/generate/bgm/stream', methods=['POST'])
+def generate_bgm_stream():
+    """
+    Stream BGM while MusicGen is generating, so it can start playing after the first chunk.
+    args:
+        prompt: music prompt,
+        seed: (optional) MusicGen seed,
+        music_model: (optional) model variant, must be in `model_pool.variants`.
+    :return:
+        chunked `audio/wav` stream, or 429 if there are already as many streams as the job pool can take.
+    """
+    args = request.args.to_dict()
+    if request.is_json:
+        args.update(request.json)
+    else:
+        args.update(request.form.to_dict())
+    if not args.get('prompt'):
+        return jsonify({'detail': 'need prompt as input!'}), 400
+    variant = args.get('music_model')
+    if variant is not None and variant not in util.config['model_pool']['variants']['music']:
+        return jsonify({'detail': f'`{variant}` is not in config.json `model_pool.variants.music`'}), 400
+    seed = int(args['seed']) if args.get('seed') is not None else None
+    if not jobs.stream_slots.acquire(blocking=False):
+        return jsonify({'detail': 'too many bgm streams are running, try again later.'}), 429
     try:
-        title = pic_comment.find('"')
-        title = title, pic_comment.find('"', title+1)
-        title = pic_comment[title[0]+1: title[1]]
+        response = Response(util.music_gen_stream(args['prompt'], seed, variant), mimetype='audio/wav',
+                            headers={'Cache-Control': 'no-cache'})
     except:
-        title = pic_comment.split('\n')[0]
-
-    if util.config['is_upload_nft']:
-        try:
-            logging.info('Uploading nft...')
-            nft_response = requests.post('https://artframe.kjchen.cloud/genNFT', json={
-                "name": title,  # NFT title
-                "to": util.config['NFT_wallet_address'],  # 鑄造出來的 NFT 要傳送到哪個錢包地址（不知道怎麼填就填一樣就好）
-                "image": img,
-                "description": pic_comment, # NFT 介紹
-                "animation_url": bgm,  # NFT 音檔
-                "attributes": [info_json]
-            })
-            if nft_response.status_code == 200:
-                nft_response = dict(nft_response.json())
-                nft_response.pop("to")
-                nft_response.pop("description")
-                nft_response.pop("attributes")
-
-                info_json.update(nft_response)
-                logging.info('Success uploading nft artwork!')
-            else:
-                logging.info(f'Fail uploading nft artwork!\nnft server response:\n{nft_response.text}')
-        except Exception as e:
-            logging.error("Can't upload artwork onto nft!", e)
-
-    return jsonify({
-        'img_comment': pic_comment,
-        'img': img,
-        'bgm': bgm,
-        'time_stmp': time_stmp,
-        'info': info_json
-    })
+        jobs.stream_slots.release()
+        raise
+    # released when the stream is done or the client disconnects
+    response.call_on_close(jobs.stream_slots.release)
+    return response
+
+@app.route('/generate/jobs/<job_id>', methods=['GET'])
+def generate_job(job_id):
+    """
+    :return:
+        job `status`. If the job is done, `result` is the same as `/generate` response.
+    """
+    job = jobs.pool.get(job_id)
+    if job is None:
+        return jsonify({'detail': f'no job `{job_id}`'}), 404
+    return jsonify(job.to_json()), job.status_code if job.status == jobs.Job.ERROR else 200
 
 if __name__ == '__main__':
+    ngrok = None
     try:
-        util.PORT = parser.parse_args().port
-        if parser.parse_args().host != 'localhost':
+        util.PORT = cli_args.port
+        if cli_args.host != 'localhost':
+            from pyngrok import ngrok
+            import line
             app.register_blueprint(line.line)
             ngrok_connect = ngrok.connect(str(util.PORT), 'http')
             line.ngrok_url = ngrok_connect.public_url
             logging.info(f'line-bot webhook public url: {ngrok_connect.public_url}/line/callback')
         else:
             logging.warning('Now using localhost as uri. So line bot won\'t activate.')
-        app.run(parser.parse_args().host, port=util.PORT, threaded=True)
+        if util.config['warm_up_models']:
+            models.registry.warm_up()
+        app.run(cli_args.host, port=util.PORT, threaded=True)
     except KeyboardInterrupt:
-        ngrok.kill()
+        if ngrok is not None:
+            ngrok.kill()
         exit(0)
\ No newline at end of file
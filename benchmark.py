@@ -0,0 +1,93 @@
+"""
+Compare the default and the CPU inference profile (`cpu_inference` in config.json) of MusicGen and whisper.
+Every profile runs in its own process, so peak RSS of one doesn't leak into the other.
+
+    python benchmark.py [--duration 5] [--music_model facebook/musicgen-small] [--whisper_model base]
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+PROFILES = ['default', 'cpu']
+
+
+def run(profile: str, args) -> dict:
+    import torch
+    import util
+    import models
+
+    def override(state: dict):
+        state['cpu_inference']['enabled'] = profile == 'cpu'
+        if args.music_model is not None:
+            state['music_model'] = args.music_model
+        if args.whisper_model is not None:
+            state['whisper_model'] = args.whisper_model
+
+    util.DEVICE = 'cpu'
+    util.config_store.update(override)
+    # don't persist the overrides into config.json
+    util.config_store.dirty = False
+    result = {'profile': profile}
+
+    t1 = time.time()
+    music_model = models.registry.get('music')
+    result['music_load'] = time.time() - t1
+    music_model.set_generation_params(duration=args.duration)
+    torch.manual_seed(0)
+    t1 = time.time()
+    with torch.inference_mode():
+        music_model.generate(['lo-fi piano with soft drums'])
+    result['music_generate'] = time.time() - t1
+
+    t1 = time.time()
+    whisper_model = models.registry.get('whisper')
+    result['whisper_load'] = time.time() - t1
+    t = np.arange(int(args.duration * util.WHISPER_SAMPLE_RATE)) / util.WHISPER_SAMPLE_RATE
+    audio = (0.1 * np.sin(2 * np.pi * 440 * t)).astype(np.float32)
+    t1 = time.time()
+    with torch.inference_mode():
+        whisper_model.transcribe(audio, task='translate', language=util.config['transcribe']['language'], fp16=False)
+    result['whisper_transcribe'] = time.time() - t1
+
+    result['threads'] = torch.get_num_threads()
+    # ru_maxrss is KB on linux
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=5, help='sec of music to generate and audio to transcribe')
+    parser.add_argument('--music_model', type=str, default=None, help='default is config.json `music_model`')
+    parser.add_argument('--whisper_model', type=str, default=None, help='default is config.json `whisper_model`')
+    parser.add_argument('--run', type=str, choices=PROFILES, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        print(json.dumps(run(args.run, args)))
+        return
+
+    results = dict()
+    for profile in PROFILES:
+        print(f'benchmark {profile} profile...')
+        output = subprocess.run([sys.executable, __file__, '--run', profile] + sys.argv[1:],
+                                check=True, stdout=subprocess.PIPE, text=True).stdout
+        results[profile] = json.loads(output.strip().split('\n')[-1])
+
+    keys = ['music_load', 'music_generate', 'whisper_load', 'whisper_transcribe']
+    print('{:<20}{:>12}{:>12}{:>10}'.format('', *PROFILES, 'speedup'))
+    for key in keys:
+        default, cpu = results['default'][key], results['cpu'][key]
+        print('{:<20}{:>11.2f}s{:>11.2f}s{:>9.2f}x'.format(key, default, cpu, default / cpu))
+    print('{:<20}{:>10.0f}MB{:>10.0f}MB'.format('peak_rss', results['default']['peak_rss_mb'],
+                                                results['cpu']['peak_rss_mb']))
+    print('{:<20}{:>12}{:>12}'.format('threads', results['default']['threads'], results['cpu']['threads']))
+
+
+if __name__ == '__main__':
+    main()
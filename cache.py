@@ -0,0 +1,166 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Union
+
+CACHE_DIR = './cache'
+
+caches: Dict[str, 'Cache'] = dict()
+
+
+def make_key(*parts: Union[str, bytes, int, float, None]) -> str:
+    """
+    Content address of `parts`, e.g. `make_key(img_bytes, voice_text, model_name, prompt)`.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            part = b'\0'
+        elif not isinstance(part, bytes):
+            part = str(part).encode('utf8')
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.hexdigest()
+
+
+class Cache:
+    """
+    Persistent LRU cache. Every entry is a file named by its key under `./cache/<name>/`, so it survives restarts.
+    Entries are evicted by least recently used when there are more than `max_entries` entries or more than
+    `max_bytes` bytes, and expire `ttl` sec after they are stored.
+    """
+    def __init__(self, name: str, max_entries: Optional[int]=None, max_bytes: Optional[int]=None,
+                 ttl: Optional[float]=None):
+        self.name = name
+        self.path = os.path.join(CACHE_DIR, name)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # key -> (size, stored time), ordered from least to most recently used
+        self.index = collections.OrderedDict()
+        self.size = 0
+
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for key in os.listdir(self.path):
+            if key.endswith('.tmp'):
+                os.remove(os.path.join(self.path, key))
+                continue
+            stat = os.stat(os.path.join(self.path, key))
+            entries.append((stat.st_mtime, key, stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self.index[key] = (size, mtime)
+            self.size += size
+        with self.lock:
+            self._evict()
+        caches[name] = self
+        logging.info(f'load `{name}` cache: {len(self.index)} entries, {self.size} bytes.')
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def _remove(self, key: str):
+        size, _ = self.index.pop(key)
+        self.size -= size
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.index and ((self.max_entries is not None and len(self.index) > self.max_entries) or
+                              (self.max_bytes is not None and self.size > self.max_bytes)):
+            self._remove(next(iter(self.index)))
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._file(key), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.index.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        with self.lock:
+            if key in self.index:
+                self._remove(key)
+            tmp = self._file(key) + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._file(key))
+            self.index[key] = (len(data), time.time())
+            self.size += len(data)
+            self._evict()
+
+    def get_json(self, key: str):
+        data = self.get(key)
+        return None if data is None else json.loads(data)
+
+    def put_json(self, key: str, value):
+        self.put(key, json.dumps(value).encode('utf8'))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.index),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class MemoryCache:
+    """
+    In-memory LRU cache for objects which can't or needn't be persisted, e.g. tensors.
+    """
+    def __init__(self, name: str, max_entries: int):
+        self.name = name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.index = collections.OrderedDict()
+        caches[name] = self
+
+    def get(self, key: str):
+        with self.lock:
+            if key not in self.index:
+                self.misses += 1
+                return None
+            self.index.move_to_end(key)
+            self.hits += 1
+            return self.index[key]
+
+    def put(self, key: str, value):
+        with self.lock:
+            self.index[key] = value
+            self.index.move_to_end(key)
+            while len(self.index) > self.max_entries:
+                self.index.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.index),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,260 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+from typing import Callable, Iterable, Optional
+
+JOURNAL_SEQ_KEY = '_journal_seq'
+
+
+class FrozenDict(dict):
+    """
+    Read-only dict of a config snapshot. `version` is the snapshot version of the root.
+    `copy.deepcopy` returns a plain mutable copy.
+    """
+    version = 0
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('config snapshot is read-only, change config by `ConfigStore.update`')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(value):
+    """
+    Copy `value` into `FrozenDict` and `tuple`.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    Copy `value` back into `dict` and `list`.
+    """
+    if isinstance(value, dict):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+
+class ConfigStore:
+    """
+    In-memory config which is the source of truth, persisted write-behind.
+
+    Changes are made under `lock` and mark the store dirty. A flush `flush_delay` sec later writes the whole config
+    once for all changes made meanwhile, by writing a temp file and renaming it over `path`, so the file is never
+    seen half written. Rating increments are also appended to `journal_path` right away, so they survive a crash
+    before the next flush. Every journal entry has a sequence number and config file records the last one it includes,
+    so replaying the journal on load never applies an increment twice.
+
+    Readers never see `state`. Every change publishes a new immutable `FrozenDict` snapshot with a higher version,
+    sharing the unchanged top-level sub-trees with the previous one, so `snapshot()` is just an attribute read. A
+    request can `pin` one snapshot, then `view()` returns it anywhere in the same context, and it won't change in the
+    middle of the request.
+    """
+    def __init__(self, path: str, default_path: str, journal_path: str, flush_delay: float=2, fsync: bool=True):
+        self.path = path
+        self.default_path = default_path
+        self.journal_path = journal_path
+        self.flush_delay = flush_delay
+        self.fsync = fsync
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.state: dict = dict()
+        self.current = FrozenDict()
+        self.listeners: list = []
+        self.pinned = contextvars.ContextVar('config_snapshot', default=None)
+        self.seq = 0
+        self.dirty = False
+        self.timer: Optional[threading.Timer] = None
+        self.load()
+
+    def _read(self) -> dict:
+        """
+        Read config file, create it by default config if it doesn't exist.
+        Keys which config file doesn't have will be filled by default config.
+        """
+        with open(self.default_path, 'r') as f:
+            default_config = json.loads(f.read())
+        try:
+            with open(self.path, 'r') as f:
+                return {**default_config, **json.loads(f.read())}
+        except FileNotFoundError:
+            self._write_file(json.dumps(default_config, indent=2))
+            return default_config
+
+    def load(self):
+        """
+        (Re)load config file and replay journal entries which are newer than it.
+        """
+        with self.lock:
+            state = self._read()
+            seq = state.pop(JOURNAL_SEQ_KEY, 0)
+            replayed = 0
+            for entry in self._journal():
+                if entry['seq'] > seq:
+                    self._apply_rating(state, entry['style'], entry['delta'])
+                    replayed += 1
+                seq = max(seq, entry['seq'])
+            self.state = state
+            self.seq = seq
+            self._publish()
+            if replayed:
+                logging.info(f'replay {replayed} config journal entries.')
+                self._schedule()
+
+    def _journal(self):
+        try:
+            with open(self.journal_path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # last line can be cut by crash
+                logging.warning(f'skip broken config journal entry: {line!r}')
+        return entries
+
+    @staticmethod
+    def _apply_rating(state: dict, style: str, delta: int) -> Optional[int]:
+        if style not in state['prompt_style']:
+            return None
+        style_config = state['prompt_style'][style]
+        style_config['random_weight'] = style_config.get('random_weight', 0) + delta
+        return style_config['random_weight']
+
+    def _publish(self, keys: Optional[Iterable[str]]=None, current: Optional[FrozenDict]=None):
+        """
+        :param keys: top-level keys which are changed, `None` means all.
+        :param current: new snapshot which is already built.
+        """
+        old = self.current
+        if current is None:
+            keys = None if keys is None else set(keys)
+            current = FrozenDict((k, old[k] if keys is not None and k not in keys and k in old else freeze(v))
+                                 for k, v in self.state.items())
+        current.version = old.version + 1
+        self.current = current
+        for listener in self.listeners:
+            listener(current)
+
+    def snapshot(self) -> FrozenDict:
+        """
+        The latest published config.
+        """
+        return self.current
+
+    @contextlib.contextmanager
+    def pin(self, snapshot: Optional[FrozenDict]=None):
+        """
+        Make `view()` return `snapshot` (default the latest one) inside this context.
+        """
+        token = self.pinned.set(snapshot if snapshot is not None else self.current)
+        try:
+            yield self.pinned.get()
+        finally:
+            self.pinned.reset(token)
+
+    def view(self) -> FrozenDict:
+        """
+        The snapshot pinned by the current context, or the latest one.
+        """
+        pinned = self.pinned.get()
+        return pinned if pinned is not None else self.current
+
+    def update(self, func: Callable[[dict], object], keys: Optional[Iterable[str]]=None):
+        """
+        Change config by `func(state)` under lock, publish a new snapshot and schedule a flush.
+        :param keys: top-level keys `func` changes, other sub-trees are shared with the previous snapshot.
+            `None` means all keys may change.
+        :return: what `func` returns.
+        """
+        with self.lock:
+            result = func(self.state)
+            self._publish(keys)
+            self._schedule()
+            return result
+
+    def add_rating(self, style: str, delta: int) -> Optional[int]:
+        """
+        Add `delta` into `random_weight` of `style` and journal it before returning.
+        :return: new `random_weight`, or `None` if `style` doesn't exist.
+        """
+        with self.lock:
+            weight = self._apply_rating(self.state, style, delta)
+            if weight is None:
+                return None
+            # only the rated style is copied, other styles are shared with the previous snapshot
+            styles = FrozenDict({**self.current['prompt_style'], style: freeze(self.state['prompt_style'][style])})
+            self._publish(current=FrozenDict({**self.current, 'prompt_style': styles}))
+            self.seq += 1
+            with open(self.journal_path, 'a') as f:
+                f.write(json.dumps({'seq': self.seq, 'style': style, 'delta': delta}) + '\n')
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            self._schedule()
+            return weight
+
+    def _schedule(self):
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(self.flush_delay, self.flush)
+            self.timer.name = 'config-flush'
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _write_file(self, data: str, path: Optional[str]=None):
+        path = path or self.path
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def flush(self):
+        """
+        Write config file now if there are unsaved changes, then drop journal entries it includes.
+        """
+        with self.flush_lock:
+            with self.lock:
+                self.timer = None
+                if not self.dirty:
+                    return
+                self.dirty = False
+                seq = self.seq
+                data = json.dumps({**self.state, JOURNAL_SEQ_KEY: seq}, indent=2)
+            try:
+                self._write_file(data)
+            except Exception as e:
+                logging.error("Can't save config!", e)
+                with self.lock:
+                    self._schedule()
+                return
+            with self.lock:
+                entries = [entry for entry in self._journal() if entry['seq'] > seq]
+                if entries:
+                    self._write_file(''.join(json.dumps(entry) + '\n' for entry in entries), self.journal_path)
+                else:
+                    try:
+                        os.remove(self.journal_path)
+                    except FileNotFoundError:
+                        pass
@@ -0,0 +1,117 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+import util
+
+
+class JobQueueFull(Exception):
+    """
+    Raised by `JobPool.submit` when the queue is full.
+    """
+
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    ERROR = 'error'
+
+    def __init__(self, func: Callable, args: tuple):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.status = Job.QUEUED
+        self.result = None
+        self.detail: Optional[str] = None
+        self.status_code = 200
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_json(self) -> dict:
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+        }
+        if self.status == Job.DONE:
+            data['result'] = self.result
+        elif self.status == Job.ERROR:
+            data['detail'] = self.detail
+        return data
+
+
+class JobPool:
+    """
+    A fixed number of worker threads behind a bounded queue.
+    Finished jobs are kept for `result_ttl` sec so client can fetch the result.
+    """
+    def __init__(self, workers: int, queue_size: int, result_ttl: float):
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jobs: Dict[str, Job] = dict()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def _start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'job-worker-{len(self.threads)}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job: Job = self.queue.get()
+            job.status = Job.RUNNING
+            logging.info(f'job {job.id} start.')
+            try:
+                job.result = job.func(*job.args)
+                job.status = Job.DONE
+            except Exception as e:
+                job.detail = getattr(e, 'detail', str(e))
+                job.status_code = getattr(e, 'status_code', 500)
+                job.status = Job.ERROR
+                logging.error(f'job {job.id} failed: {job.detail}')
+            job.finished_at = time.time()
+            job.func, job.args = None, None
+            logging.info('job {} {}. take {:.2f} sec.'.format(job.id, job.status, job.finished_at - job.created_at))
+            self.queue.task_done()
+
+    def _expire(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and now - job.finished_at > self.result_ttl:
+                self.jobs.pop(job_id)
+
+    def submit(self, func: Callable, *args) -> Job:
+        """
+        Queue `func(*args)`.
+        :raise JobQueueFull: if there are already `queue_size` jobs waiting.
+        """
+        job = Job(func, args)
+        with self.lock:
+            self._start()
+            self._expire()
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                raise JobQueueFull(f'job queue is full ({self.queue.maxsize} jobs waiting), try again later.')
+            self.jobs[job.id] = job
+        logging.info(f'job {job.id} queued. ({self.queue.qsize()} waiting)')
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+
+pool = JobPool(int(util.config['job_pool']['workers']),
+               int(util.config['job_pool']['queue_size']),
+               float(util.config['job_pool']['result_ttl']))
+
+# streaming routes generate on the request thread instead of the pool, but are limited to the same capacity
+stream_slots = threading.BoundedSemaphore(int(util.config['job_pool']['workers']) +
+                                          int(util.config['job_pool']['queue_size']))
@@ -1,11 +1,10 @@
 import base64
+import io
 import json
 import logging
 import os.path
 from typing import Optional
-from pydub import AudioSegment
 
-import requests
 from PIL import Image
 from flask import Blueprint
 from flask import current_app
@@ -18,6 +17,8 @@ from linebot.models import (
     ButtonsTemplate, QuickReply, QuickReplyButton)
 from linebot.models.events import MessageEvent as MsgEvent, PostbackEvent
 
+import jobs
+import pipeline
 import util
 
 line = Blueprint('line', __name__, url_prefix='/line')
@@ -85,8 +86,10 @@ def handle_text_message(event: MsgEvent):
                                                                                             input_option='openKeyboard',
                                                                                             fill_in_text=f'!delete {style}')
                                                                          ])))
-            if os.path.isfile(f'./static/style_example/{style}.png'.replace(' ', '_').replace('-', '_')):
-                messages.append(ImageSendMessage(f"{ngrok_url}/style_example/" + f"{style}.png".replace(' ', '_').replace('-', '_'), f"{ngrok_url}/style_example/" + f"{style}.png".replace(' ', '_').replace('-', '_')))
+            example = util.find_style_example(style)
+            if example is not None:
+                example_url = f"{ngrok_url}/style_example/" + os.path.basename(example)
+                messages.append(ImageSendMessage(example_url, example_url))
             else:
                 messages.append(TextSendMessage("This style doesn't have example Image."))
         messages.append(TemplateSendMessage(alt_text=f'use `!style random` to change prompt style!',
@@ -142,8 +145,7 @@ def handle_text_message(event: MsgEvent):
             )
             return
         try:
-            util.config['prompt_style'].pop(style)
-            util.save_config()
+            util.config_store.update(lambda state: state['prompt_style'].pop(style), ['prompt_style'])
             line_bot_api.reply_message(
                 event.reply_token,
                 TextSendMessage(f'successfully delete style: ({style})')
@@ -229,8 +231,7 @@ def handle_text_message(event: MsgEvent):
         if new_bgm_prompt[0] == ' ':
             new_bgm_prompt = new_bgm_prompt[1:]
 
-        util.config['prompt_style'][new_prompt_style_title]['bgm_prompt'] = new_bgm_prompt
-        util.save_config()
+        util.save_config('prompt_style', {new_prompt_style_title: {'bgm_prompt': new_bgm_prompt}})
 
         # Next step: random weight
         buttons_template = ButtonsTemplate(
@@ -256,8 +257,7 @@ def handle_text_message(event: MsgEvent):
         except:
             new_random_weight = 0
 
-        util.config['prompt_style'][new_prompt_style_title]['random_weight'] = new_random_weight
-        util.save_config()
+        util.save_config('prompt_style', {new_prompt_style_title: {'random_weight': new_random_weight}})
 
         # Next step: random weight
         buttons_template = ButtonsTemplate(
@@ -333,9 +333,7 @@ def handle_postback_message(event):
         prompt_style_title = prompt_style_title.split(':')[-1]
         rating = int(rating.split(':')[-1])
 
-        if prompt_style_title in util.config['prompt_style']:
-            util.config['prompt_style'][prompt_style_title]['random_weight'] += rating
-            util.save_config()
+        util.config_store.add_rating(prompt_style_title, rating)
 
         line_bot_api.reply_message(
             event.reply_token,
@@ -343,65 +341,87 @@ def handle_postback_message(event):
 
 @handler.add(MessageEvent, message=ImageMessage)
 def handle_image_message(event):
-    message_content = line_bot_api.get_message_content(event.message.id)
-
-    result = requests.post(f'http://localhost:{util.PORT}/generate',
-                           json={
-                               'img': base64.b64encode(message_content.content).decode('utf8')
-                           }
-    )
-    status_code = result.status_code
-    result = result.json()
-
-    if status_code == 200:
-        preview = Image.open(util.IMG_OUTPUT)
-        preview = preview.resize((preview.size[0]//2, preview.size[1]//2))
-
-        AudioSegment.from_wav(util.BGM_OUTPUT).export(util.BGM_OUTPUT[:-4] + '.mp3', format='mp3')
-
-        log_path = f"./static/log/{result['time_stmp']}"
-        preview.save(log_path + util.IMG_OUTPUT_PREVIEW[8:], format='png')
-        raspberrypi_result = None
-        try:
-            raspberrypi_result = requests.post(util.config['raspberrypi_server'] + '/line_get_generate',
-                json=result,
-                headers={
-                    'ngrok-skip-browser-warning':
-                    'use it to skip ngrok warning. this value can be anything.'
-                }
-           )
-        except Exception as e:
-            logging.error(f"Can't connect to raspberrypi! Set up in config or go to {ngrok_url} to set up!", e)
-
-        text = result['img_comment'] + '\n\n - by ChatGPT4'
-
-        text += '\n\n' + (("AI artwork has been uploaded on OpenSea!\n" + result["info"]["os_url"]) if result["info"].get("os_url", False) else 'Oops! Can\'t upload AI artwork on OpenSea!')
-
-        if raspberrypi_result is None or raspberrypi_result.status_code != 200:
-            text += f"\n\nCan't connect to raspberrypi!\nSet up in config or go to {ngrok_url} to set up!"
-
-        original_img_url = result['info'].get('image', f"{ngrok_url}{log_path[1:]}{util.IMG_OUTPUT[8:]}")
-        original_bgm_url = result['info'].get('animation_url', f"{ngrok_url}{log_path[1:]}{util.BGM_OUTPUT[8: -4]}.mp3")
-        rating = QuickReply(items=[
-            QuickReplyButton(action=PostbackAction(label='Excellent', data=f'rating:2,style:{result["info"]["prompt_style"]}')),
-            QuickReplyButton(action=PostbackAction(label='Very Good', data=f'rating:1,style:{result["info"]["prompt_style"]}')),
-            QuickReplyButton(action=PostbackAction(label='Fair', data=f'rating:0,style:{result["info"]["prompt_style"]}')),
-            QuickReplyButton(action=PostbackAction(label='Poor', data=f'rating:-1,style:{result["info"]["prompt_style"]}')),
-            QuickReplyButton(action=PostbackAction(label='Unacceptable', data=f'rating:-2,style:{result["info"]["prompt_style"]}'))])
+    """
+    Generate in background, so the webhook returns at once. Results are pushed to the chat when they are done.
+    """
+    try:
+        jobs.pool.submit(generate_for_line, push_target(event.source), event.message.id)
+    except jobs.JobQueueFull:
         line_bot_api.reply_message(
             event.reply_token,
-            [
-                ImageSendMessage(
-                    original_content_url=original_img_url,
-                    preview_image_url=f"{ngrok_url}{log_path[1:]}{util.IMG_OUTPUT_PREVIEW[8:]}"
-                ),
-                TextSendMessage(text),
-                AudioSendMessage(original_bgm_url, int(util.config["BGM_duration"])),
-                TextSendMessage(text='Are you satisfied with the output?', quick_reply = rating)
-            ]
+            TextSendMessage('Server is busy, please send the image again later.')
         )
-    else:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage('Error!\n```\n' + json.dumps(result, indent=2) + '\n```')
-        )
\ No newline at end of file
+
+def push_target(source) -> str:
+    """
+    :return: id of the group, room or user chat which `source` is from.
+    """
+    if source.type == 'group':
+        return source.group_id
+    if source.type == 'room':
+        return source.room_id
+    return source.user_id
+
+def generate_for_line(to: str, message_id: str):
+    """
+    Download the image, run the pipeline in-process and push results to the chat `to`.
+    """
+    artifacts = util.Artifacts()
+    try:
+        message_content = line_bot_api.get_message_content(message_id)
+        result = pipeline.generate({'img': message_content.content, 'response': 'url'}, artifacts=artifacts)
+    except Exception as e:
+        line_bot_api.push_message(
+            to,
+            TextSendMessage('Error!\n```\n' + json.dumps({'detail': getattr(e, 'detail', str(e))}, indent=2) + '\n```')
+        )
+        raise
+
+    log_path = f"./static/log/{result['time_stmp']}"
+    preview = Image.open(io.BytesIO(artifacts.get(util.IMG_OUTPUT)))
+    preview = preview.resize((preview.size[0]//2, preview.size[1]//2))
+
+    preview.save(log_path + util.IMG_OUTPUT_PREVIEW[8:], format='png')
+    raspberrypi_result = None
+    try:
+        raspberrypi_result = util.http_post(util.config['raspberrypi_server'] + '/line_get_generate',
+            json={
+                **result,
+                'img': base64.b64encode(artifacts.get(util.IMG_OUTPUT)).decode('utf8'),
+                'bgm': base64.b64encode(artifacts.get(util.BGM_OUTPUT)).decode('utf8')
+            },
+            headers={
+                'ngrok-skip-browser-warning':
+                'use it to skip ngrok warning. this value can be anything.'
+            }
+       )
+    except Exception as e:
+        logging.error(f"Can't connect to raspberrypi! Set up in config or go to {ngrok_url} to set up!", e)
+
+    text = result['img_comment'] + '\n\n - by ChatGPT4'
+
+    text += '\n\n' + (("AI artwork has been uploaded on OpenSea!\n" + result["info"]["os_url"]) if result["info"].get("os_url", False) else 'Oops! Can\'t upload AI artwork on OpenSea!')
+
+    if raspberrypi_result is None or raspberrypi_result.status_code != 200:
+        text += f"\n\nCan't connect to raspberrypi!\nSet up in config or go to {ngrok_url} to set up!"
+
+    original_img_url = result['info'].get('image', f"{ngrok_url}{result['img']['url']}")
+    original_bgm_url = result['info'].get('animation_url', f"{ngrok_url}{result['bgm']['url']}")
+    rating = QuickReply(items=[
+        QuickReplyButton(action=PostbackAction(label='Excellent', data=f'rating:2,style:{result["info"]["prompt_style"]}')),
+        QuickReplyButton(action=PostbackAction(label='Very Good', data=f'rating:1,style:{result["info"]["prompt_style"]}')),
+        QuickReplyButton(action=PostbackAction(label='Fair', data=f'rating:0,style:{result["info"]["prompt_style"]}')),
+        QuickReplyButton(action=PostbackAction(label='Poor', data=f'rating:-1,style:{result["info"]["prompt_style"]}')),
+        QuickReplyButton(action=PostbackAction(label='Unacceptable', data=f'rating:-2,style:{result["info"]["prompt_style"]}'))])
+    line_bot_api.push_message(
+        to,
+        [
+            ImageSendMessage(
+                original_content_url=original_img_url,
+                preview_image_url=f"{ngrok_url}{log_path[1:]}{util.IMG_OUTPUT_PREVIEW[8:]}"
+            ),
+            TextSendMessage(text),
+            AudioSendMessage(original_bgm_url, int(util.config["BGM_duration"])),
+            TextSendMessage(text='Are you satisfied with the output?', quick_reply = rating)
+        ]
+    )
@@ -0,0 +1,203 @@
+import collections
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+
+class ModelRegistry:
+    """
+    Load each model on first use instead of at import, so the server can start serving non-ML routes immediately.
+    `warm_up` can load models in background before the first request needs them.
+
+    Every model has a configured variant (e.g. `facebook/musicgen-small`) which is served by default, but callers can
+    ask for another variant. Loaded variants stay resident until their total size is over `max_bytes`, then the least
+    recently used ones are evicted (except the variants being served by default), so switching back to a resident
+    variant costs nothing. `swap` loads a new default variant in background and keeps serving the old one until the
+    new one is ready.
+    """
+    def __init__(self, max_bytes: Optional[int]=None):
+        self.max_bytes = max_bytes
+        self.loaders: Dict[str, Callable[[str], object]] = dict()
+        self.variants: Dict[str, Callable[[], str]] = dict()
+        # name -> default variant which is serving now
+        self.active: Dict[str, str] = dict()
+        # (name, variant) -> (model, bytes), ordered from least to most recently used
+        self.resident = collections.OrderedDict()
+        self.locks: Dict[str, threading.Lock] = dict()
+        self.pool_lock = threading.Lock()
+        self.loading: Dict[str, str] = dict()
+
+    def register(self, name: str, loader: Callable[[str], object], variant: Callable[[], str]):
+        """
+        :param loader: called with variant name to load the model.
+        :param variant: return the variant which should be served by default now, e.g. read from config.
+        """
+        self.loaders[name] = loader
+        self.variants[name] = variant
+        self.locks[name] = threading.Lock()
+
+    def _load(self, name: str, variant: str):
+        self.loading[name] = variant
+        try:
+            logging.info(f'Load {name} model `{variant}`...')
+            t1 = time.time()
+            model = self.loaders[name](variant)
+            logging.info('Load {} model `{}` done. take {:.2f} sec.'.format(name, variant, time.time() - t1))
+            return model
+        finally:
+            self.loading.pop(name, None)
+
+    def _evict(self):
+        evicted = False
+        with self.pool_lock:
+            total = sum(size for _, size in self.resident.values())
+            for key in list(self.resident.keys()):
+                if self.max_bytes is None or total <= self.max_bytes:
+                    break
+                if self.active.get(key[0]) == key[1]:
+                    continue
+                total -= self.resident.pop(key)[1]
+                logging.info(f'evict {key[0]} model `{key[1]}`.')
+                evicted = True
+        if evicted:
+            free_memory()
+
+    def _get_resident(self, name: str, variant: str):
+        with self.pool_lock:
+            entry = self.resident.get((name, variant))
+            if entry is not None:
+                self.resident.move_to_end((name, variant))
+                return entry[0]
+        return None
+
+    def get_with_variant(self, name: str, variant: Optional[str]=None) -> Tuple[object, str]:
+        """
+        Return a model and its variant, load it first if it isn't resident. Concurrent callers wait for the same load.
+        :param variant: `None` means the variant which is serving by default.
+        """
+        if variant is None:
+            variant = self.active.get(name) or self.variants[name]()
+        model = self._get_resident(name, variant)
+        if model is not None:
+            return model, variant
+        with self.locks[name]:
+            model = self._get_resident(name, variant)
+            if model is None:
+                model = self._load(name, variant)
+                with self.pool_lock:
+                    self.resident[(name, variant)] = (model, model_bytes(model))
+                    # a per-request variant, or a configured one which is changed while loading, isn't the default
+                    if variant == self.variants[name]():
+                        self.active.setdefault(name, variant)
+                self._evict()
+            return model, variant
+
+    def get(self, name: str, variant: Optional[str]=None):
+        return self.get_with_variant(name, variant)[0]
+
+    def variant(self, name: str) -> str:
+        """
+        Variant which is serving by default now, or the configured variant if no model is loaded.
+        """
+        return self.active.get(name) or self.variants[name]()
+
+    def is_loaded(self, name: str, variant: Optional[str]=None) -> bool:
+        return (name, variant or self.variant(name)) in self.resident
+
+    def loaded(self, name: str) -> Iterable[object]:
+        """
+        All resident models of `name`.
+        """
+        with self.pool_lock:
+            return [model for (n, _), (model, _) in self.resident.items() if n == name]
+
+    def swap(self, name: str) -> Optional[threading.Thread]:
+        """
+        Load the configured variant in background. Callers keep getting the old default model until the new one is
+        loaded, then the default is switched atomically. The old one stays resident until it's evicted by budget.
+        If no model is loaded or loading yet, nothing is loaded now, the configured variant will be loaded on next `get`.
+        If a model is still loading, e.g. by warm up, the configured variant is loaded after it.
+        """
+        if name not in self.active and name not in self.loading:
+            return None
+
+        def load():
+            variant = self.variants[name]()
+            try:
+                self.get(name, variant)
+            except Exception as e:
+                logging.error(f"Can't load {name} model `{variant}`, keep using the old one.", e)
+                return
+            if self.variants[name]() != variant:
+                return
+            self.active[name] = variant
+            logging.info(f'{name} model is swapped to `{variant}`.')
+            self._evict()
+        thread = threading.Thread(target=load, name=f'{name}-model-swap', daemon=True)
+        thread.start()
+        return thread
+
+    def set_budget(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def warm_up(self, names: Optional[Iterable[str]]=None) -> threading.Thread:
+        """
+        Load models in a background thread.
+        :param names: models to load, all registered models by default.
+        """
+        names = list(self.loaders.keys()) if names is None else list(names)
+
+        def load():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    logging.error(f"Can't warm up {name} model!", e)
+        thread = threading.Thread(target=load, name='model-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def status(self) -> Dict[str, dict]:
+        with self.pool_lock:
+            return {
+                name: {
+                    'state': 'loaded' if (name, self.variant(name)) in self.resident else
+                             'loading' if name in self.loading else 'not loaded',
+                    'variant': self.active.get(name),
+                    'loading': self.loading.get(name),
+                    'resident': {v: size for (n, v), (_, size) in self.resident.items() if n == name}
+                }
+                for name in self.loaders
+            }
+
+
+def model_bytes(model) -> int:
+    """
+    Size of the state of a `torch.nn.Module`, or of all modules a model object holds (e.g. MusicGen).
+    State dict is used instead of parameters, so packed weights of quantized layers are counted too.
+    """
+    import torch
+    if isinstance(model, torch.nn.Module):
+        modules = [model]
+    else:
+        modules = [v for v in vars(model).values() if isinstance(v, torch.nn.Module)]
+
+    def size(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(size(v) for v in value)
+        return 0
+    return sum(size(v) for m in modules for v in m.state_dict().values())
+
+
+def free_memory():
+    import gc
+    import torch
+    gc.collect()
+    torch.cuda.empty_cache()
+
+
+registry = ModelRegistry()
@@ -0,0 +1,307 @@
+import base64
+import concurrent.futures
+import contextvars
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+import util
+
+
+class PipelineError(Exception):
+    """
+    Raised when the generation pipeline can't produce a result. `detail` will be sent back to the client.
+    """
+    def __init__(self, detail: str, status_code: int=400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+class StageGraph:
+    """
+    Run pipeline stages concurrently. Every stage starts as soon as all the stages it depends on are done.
+    Stages run in a copy of the caller's context, so they see the config snapshot the caller pinned.
+    """
+    def __init__(self):
+        self.stages: Dict[str, tuple] = dict()
+        self.timings: Dict[str, float] = dict()
+
+    def add(self, name: str, func: Callable, deps: Iterable[str]=()):
+        """
+        Add a stage into graph. Dependencies must be added before the stage depends on them, so graph can't have cycle.
+        :param name: stage name, also the key of its result.
+        :param func: stage function. It will be called with the results of `deps` as positional args.
+        :param deps: names of the stages which should be done before this stage start.
+        """
+        deps = tuple(deps)
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f'stage `{name}` depends on unknown stage `{dep}`')
+        self.stages[name] = (func, deps)
+        return self
+
+    def _run_stage(self, name: str, func: Callable, *args):
+        t1 = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.timings[name] = time.time() - t1
+            logging.info('stage `{}` done. take {:.2f} sec.'.format(name, self.timings[name]))
+
+    def run(self, on_stage_done: Optional[Callable[[str, object], None]]=None) -> Dict[str, object]:
+        """
+        Run all stages. If any stage raise an exception, stages which haven't started will be cancelled and the
+        exception will be re-raised.
+        :param on_stage_done: called with stage name and result as soon as a stage is done.
+        :return: `dict` of stage name to its result.
+        """
+        results = dict()
+        pending = dict(self.stages)
+        running = dict()
+        t1 = time.time()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.stages), 1),
+                                                         thread_name_prefix='stage')
+        try:
+            while pending or running:
+                for name, (func, deps) in list(pending.items()):
+                    if all(dep in results for dep in deps):
+                        pending.pop(name)
+                        future = executor.submit(contextvars.copy_context().run, self._run_stage, name, func,
+                                                 *[results[dep] for dep in deps])
+                        running[future] = name
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    if on_stage_done is not None:
+                        on_stage_done(name, results[name])
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown(wait=False)
+        logging.info('stage graph done. take {:.2f} sec. ({})'.format(
+            time.time() - t1, ', '.join('{}: {:.2f}'.format(k, v) for k, v in self.timings.items())))
+        return results
+
+
+def choose_prompt_style(image_prompt: str='', bgm_prompt: str=''):
+    """
+    Fill `image_prompt` and `bgm_prompt` by `now_prompt_style` if both of them are empty.
+    :return: (style, image_prompt, bgm_prompt)
+    """
+    config = util.current_config()
+    style = None
+    if image_prompt == '' and bgm_prompt == '' and config['now_prompt_style'] is not None:
+        if config['now_prompt_style'] == util.RANDOM_PROMPT_STYLE:
+            logging.info('use prompt style: ' + config['now_prompt_style'])
+            style = util.style_sampler.sample()
+            logging.info('random prompt style: ' + style)
+        else:
+            style = config['now_prompt_style']
+            if style in config['prompt_style']:
+                logging.info('use prompt style: ' + config['now_prompt_style'])
+            else:
+                logging.info(f'Not find `{config["now_prompt_style"]}` prompt style.')
+        try:
+            image_prompt = config["prompt_style"][style]['image_prompt']
+        except:
+            logging.info(f'Not find `image_prompt` in `{style}` prompt style.')
+        try:
+            bgm_prompt = config["prompt_style"][style]['bgm_prompt']
+        except:
+            logging.info(f'Not find `bgm_prompt` in `{style}` prompt style.')
+    return style, image_prompt, bgm_prompt
+
+
+def generate(args: dict, on_event: Optional[Callable[[str, dict], None]]=None,
+             artifacts: Optional[util.Artifacts]=None) -> dict:
+    """
+    Run the whole generation pipeline.
+
+    Stages run as a graph: interrogate and transcribe run together, GPT4 waits for the transcription, the image
+    waits for GPT4 and interrogate, BGM only needs GPT4 so it overlaps the image, and the comment overlaps BGM.
+    The whole run reads the config snapshot taken at its start, even if config is changed meanwhile.
+    :param args: same as `/generate` http body.
+    :param on_event: called with event name and data when a stage is done. events are `transcription`, `prompts`,
+        `image`, `bgm` and `comment`.
+    :param artifacts: if not None, generated files are put into it, so in-process callers needn't read them back.
+    :return: a dict include `img_comment`, `img`, `bgm`, `time_stmp` and `info`.
+    """
+    with util.config_store.pin() as config:
+        logging.info(f'generate with config version {config.version}')
+        return _generate(args, on_event, config, artifacts if artifacts is not None else util.Artifacts())
+
+
+def _generate(args: dict, on_event: Optional[Callable[[str, dict], None]], config: dict,
+              artifacts: util.Artifacts) -> dict:
+    img = args.get('img')
+    try:
+        input_image = util.PreprocessedImage(img if isinstance(img, bytes) else base64.b64decode(img))
+    except:
+        raise PipelineError('need img as input!')
+    artifacts.put(util.IMG_INPUT, input_image.png())
+    voice: Optional[bytes] = args.get('voice', None)
+    seed: Optional[int] = int(args['seed']) if args.get('seed') is not None else None
+    music_variant: Optional[str] = args.get('music_model')
+    whisper_variant: Optional[str] = args.get('whisper_model')
+    for name, variant in (('music', music_variant), ('whisper', whisper_variant)):
+        if variant is not None and variant not in config['model_pool']['variants'][name]:
+            raise PipelineError(f'`{variant}` is not in config.json `model_pool.variants.{name}`')
+    style, image_prompt, bgm_prompt = choose_prompt_style(args.get('image_prompt', ''), args.get('bgm_prompt', ''))
+
+    if config['image_generate_api'].lower() in util.IMAGE_GENERATE_API['sd']:
+        image_generate_pipline = util.stable_diffusion_pipline
+    elif config['image_generate_api'].lower() in util.IMAGE_GENERATE_API['dall-e']:
+        image_generate_pipline = util.DALL_E_pipline
+    else:
+        raise PipelineError(f'set config.json `image_generate_api` as {util.IMAGE_GENERATE_API}')
+    logging.info(f'Image api: {image_generate_pipline.__name__}')
+
+    if isinstance(voice, str):
+        voice = base64.b64decode(voice)
+    if voice is not None:
+        artifacts.put(util.VOICE_PROMPT, voice)
+
+    def interrogate():
+        if image_generate_pipline is not util.stable_diffusion_pipline:
+            return ''
+        return util.interrogate_pipline(input_image)
+
+    def transcribe():
+        if voice is None:
+            return ''
+        voice_prompt = util.transcribe(voice, whisper_variant)
+        logging.info('transcribe voice: ' + voice_prompt)
+        return voice_prompt
+
+    def gpt4(voice_prompt: str):
+        try:
+            gpt4_reply = util.GPT4_pipline(input_image.thumbnail, voice_prompt)
+        except RuntimeError as e:
+            logging.error(e.args[0], e)
+            raise PipelineError(e.args[0])
+        logging.info('gpt4_reply: ' + str(gpt4_reply))
+        return gpt4_reply
+
+    def image(interrogate_img_prompt: str, gpt4_reply: dict):
+        init_image = None
+        if image_generate_pipline is util.stable_diffusion_pipline:
+            init_image = input_image.sd_init_image(int(config['sd_payload']['width']),
+                                                   int(config['sd_payload']['height']))
+        generated = image_generate_pipline(image_prompt + interrogate_img_prompt + gpt4_reply["img_prompt"],
+                                           init_image, artifacts)
+        if isinstance(generated, tuple):
+            logging.error(generated[1][0], str(generated[1]))
+            raise PipelineError(str(generated[1]))
+        return generated
+
+    def music_prompt(voice_prompt: str, gpt4_reply: dict):
+        return bgm_prompt + ('"' + voice_prompt + '", ' if voice_prompt != '' else '') + gpt4_reply["bgm_prompt"]
+
+    def music(voice_prompt: str, gpt4_reply: dict):
+        return util.music_gen_pipline(music_prompt(voice_prompt, gpt4_reply),
+                                      voice if voice_prompt != '' else None, artifacts, seed, music_variant)
+
+    def comment(generated: str):
+        logging.info('GPT4 commenting...')
+        pic_comment = util.GPT4_pipline(util.PreprocessedImage(artifacts.get(util.IMG_OUTPUT) or
+                                                               base64.b64decode(generated)).thumbnail)
+        logging.info('GPT4 comment: ' + pic_comment)
+        return pic_comment
+
+    def on_stage_done(name: str, result):
+        if on_event is None:
+            return
+        if name == 'transcribe' and result != '':
+            on_event('transcription', {'text': result})
+        elif name == 'gpt4':
+            on_event('prompts', {
+                'img_prompt': result['img_prompt'],
+                'bgm_prompt': result['bgm_prompt']
+            })
+        elif name == 'image':
+            on_event('image', {'img': result})
+        elif name == 'music':
+            on_event('bgm', {'bgm': result})
+        elif name == 'comment':
+            on_event('comment', {'img_comment': result})
+
+    results = StageGraph() \
+        .add('interrogate', interrogate) \
+        .add('transcribe', transcribe) \
+        .add('gpt4', gpt4, ['transcribe']) \
+        .add('image', image, ['interrogate', 'gpt4']) \
+        .add('music', music, ['transcribe', 'gpt4']) \
+        .add('comment', comment, ['image']) \
+        .run(on_stage_done)
+    img, bgm, pic_comment = results['image'], results['music'], results['comment']
+
+    logging.info('Logging generate result...')
+    time_stmp = time.strftime("%Y_%m_%d_%H_%M_%S", time.localtime(time.time()))
+    log_path = f'./static/log/{time_stmp}/'
+
+    i = 1
+    while True:
+        try:
+            os.makedirs(log_path)
+            break
+        except FileExistsError:
+            log_path = f'./static/log/{time_stmp}({i})/'
+            i += 1
+    time_stmp = log_path.split('/')[-2]
+
+    artifacts.save(log_path)
+    info_json = {
+        'img_prompt': image_prompt + results['interrogate'] + results['gpt4']["img_prompt"],
+        'bgm_prompt': music_prompt(results['transcribe'], results['gpt4']),
+        'now_prompt_style': config['now_prompt_style'],
+        "prompt_style": style,
+    }
+    with open(log_path + 'info.json', 'w') as f:
+        f.write(json.dumps(info_json, indent=2))
+
+    try:
+        title = pic_comment.find('"')
+        title = title, pic_comment.find('"', title+1)
+        title = pic_comment[title[0]+1: title[1]]
+    except:
+        title = pic_comment.split('\n')[0]
+
+    if config['is_upload_nft']:
+        try:
+            logging.info('Uploading nft...')
+            nft_response = util.http_post('https://artframe.kjchen.cloud/genNFT', json={
+                "name": title,  # NFT title
+                "to": config['NFT_wallet_address'],  # 鑄造出來的 NFT 要傳送到哪個錢包地址（不知道怎麼填就填一樣就好）
+                "image": img,
+                "description": pic_comment, # NFT 介紹
+                "animation_url": bgm,  # NFT 音檔
+                "attributes": [info_json]
+            })
+            if nft_response.status_code == 200:
+                nft_response = dict(nft_response.json())
+                nft_response.pop("to")
+                nft_response.pop("description")
+                nft_response.pop("attributes")
+
+                info_json.update(nft_response)
+                logging.info('Success uploading nft artwork!')
+            else:
+                logging.info(f'Fail uploading nft artwork!\nnft server response:\n{nft_response.text}')
+        except Exception as e:
+            logging.error("Can't upload artwork onto nft!", e)
+
+    if args.get('response') == 'url':
+        img = artifacts.describe(util.IMG_OUTPUT, log_path)
+        bgm = artifacts.describe(util.BGM_OUTPUT, log_path)
+
+    return {
+        'img_comment': pic_comment,
+        'img': img,
+        'bgm': bgm,
+        'time_stmp': time_stmp,
+        'info': info_json
+    }
@@ -12,7 +12,7 @@ import logging
 from waveshare_epd import epd7in3f
 import time
 from PIL import Image  # ,ImageDraw,ImageFont
-import base64, requests  # , traceback
+import requests  # , traceback
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -22,21 +22,38 @@ p = ap.ArgumentParser()
 p.add_argument("--api_path", default="https://78fa-140-122-136-198.ngrok-free.app", help="Use Generated AI or not")
 p.add_argument("--img_path", help="The path of image, which you want to print it on ePaper")
 p.add_argument("--useGeneratedAI", default="Y", help="Use Generated AI or not")
+p.add_argument("--poll_interval", default=3, type=float, help="How many seconds to wait between polling generate job")
 args = p.parse_args()
 
 if args.useGeneratedAI == "Y":
     with open(args.img_path, 'rb') as f:
-        img = base64.b64encode(f.read()).decode('utf8')
-    response = requests.post(
-        args.api_path + "/generate",
-        headers={'ngrok-skip-browser-warning': 'use it to skip ngrok warning. this value can be anything.'},
-        json={'img': img}  # , 'voice': voice # Optional }
-    ).json();
-    img = response['img'];
-    img_comment = response['img_comment']  # bgm = response['bgm']
+        img = f.read()
+    headers = {'ngrok-skip-browser-warning': 'use it to skip ngrok warning. this value can be anything.'}
+    while True:
+        response = requests.post(
+            args.api_path + "/generate/jobs",
+            headers=headers,
+            files={'img': img},  # , 'voice': voice # Optional }
+            data={'response': 'url'}
+        )
+        if response.status_code != 429:
+            break
+        logging.info('server is busy, retry later...')
+        time.sleep(args.poll_interval)
+    job_id = response.json()['job_id']
+    while True:
+        time.sleep(args.poll_interval)
+        response = requests.get(args.api_path + "/generate/jobs/" + job_id, headers=headers).json()
+        if response['status'] not in ('queued', 'running'):
+            break
+    if response['status'] != 'done':
+        raise RuntimeError(response.get('detail'))
+    response = response['result']
+    img = requests.get(args.api_path + response['img']['url'], headers=headers).content
+    img_comment = response['img_comment']  # bgm = requests.get(args.api_path + response['bgm']['url']).content
 
     with open('./rcv_img.png', 'wb') as f:
-        f.write(base64.b64decode(img))
+        f.write(img)
     args.img_path = './rcv_img.png'
     print(f'Save to {args.img_path}')
     print(img_comment)
@@ -0,0 +1,104 @@
+import math
+import random
+import threading
+from typing import Dict, Hashable, List, Optional
+
+
+class SoftmaxSampler:
+    """
+    Sample keys with softmax probability of their weights, `exp(w) / sum(exp(w))`.
+
+    `exp(w - shift)` of every key is kept in a Fenwick tree, so changing one weight is O(log n) and sampling is
+    O(log n), instead of recomputing softmax over all weights every time. Softmax doesn't depend on `shift`, so it's
+    only moved to the max weight (and the tree rebuilt, O(n)) when a weight goes above it, or when the total falls
+    below 1 because the max weight decreased. So every value is at most 1 and the total is at least 1, and adding a
+    delta into tree nodes never cancels a large value against small ones. The tree is also rebuilt after many updates
+    to drop accumulated rounding error.
+    """
+    REBUILD_EVERY = 4096
+
+    def __init__(self, weights: Optional[Dict[Hashable, float]]=None):
+        self.lock = threading.Lock()
+        self.keys: List[Hashable] = []
+        self.index: Dict[Hashable, int] = dict()
+        self.weights: List[float] = []
+        self.values: List[float] = []
+        self.tree: List[float] = [0.]
+        self.shift = 0.
+        self.total = 0.
+        self.updates = 0
+        self.rebuild(weights or dict())
+
+    def rebuild(self, weights: Dict[Hashable, float]):
+        """
+        Replace all keys and weights. O(n).
+        """
+        with self.lock:
+            self.keys = list(weights.keys())
+            self.index = {k: i for i, k in enumerate(self.keys)}
+            self.weights = [float(weights[k]) for k in self.keys]
+            self._build()
+
+    def _build(self):
+        self.shift = max(self.weights, default=0.)
+        self.values = [math.exp(w - self.shift) for w in self.weights]
+        self.tree = [0.] + self.values
+        n = len(self.values)
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+        self.total = math.fsum(self.values)
+        self.updates = 0
+
+    def update(self, key: Hashable, weight: float):
+        """
+        Change the weight of an existing key. O(log n).
+        """
+        with self.lock:
+            i = self.index[key]
+            weight = float(weight)
+            self.weights[i] = weight
+            if weight > self.shift or self.updates >= self.REBUILD_EVERY:
+                self._build()
+                return
+            value = math.exp(weight - self.shift)
+            delta = value - self.values[i]
+            self.values[i] = value
+            j = i + 1
+            while j < len(self.tree):
+                self.tree[j] += delta
+                j += j & -j
+            self.total = self._prefix_sum(len(self.values))
+            self.updates += 1
+            if self.total < 1:
+                self._build()
+
+    def _prefix_sum(self, n: int) -> float:
+        total = 0.
+        while n > 0:
+            total += self.tree[n]
+            n -= n & -n
+        return total
+
+    def sample(self, rng: random.Random=random) -> Optional[Hashable]:
+        """
+        :return: a key, or `None` if there is no key.
+        """
+        with self.lock:
+            n = len(self.keys)
+            if n == 0:
+                return None
+            r = rng.random() * self.total
+            pos = 0
+            step = 1 << (n.bit_length() - 1)
+            while step:
+                if pos + step <= n and self.tree[pos + step] <= r:
+                    pos += step
+                    r -= self.tree[pos]
+                step >>= 1
+            return self.keys[min(pos, n - 1)]
+
+    def probabilities(self) -> Dict[Hashable, float]:
+        with self.lock:
+            return {k: v / self.total for k, v in zip(self.keys, self.values)}
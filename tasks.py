@@ -0,0 +1,68 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Hashable, Tuple
+
+
+class BackgroundQueue:
+    """
+    Run keyed tasks in background worker threads.
+
+    Submitting a key which is still waiting only replaces its arguments, so a burst of edits of the same thing runs
+    once with the latest arguments. Submitting a key which is already running queues it again, so the latest
+    arguments always get a run. A failed task is retried `retries` times, waiting `backoff * 2 ** n` sec between tries.
+    """
+    def __init__(self, name: str, workers: int=1, retries: int=2, backoff: float=5):
+        self.name = name
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        # key -> (func, args) of waiting tasks
+        self.waiting: Dict[Hashable, Tuple[Callable, tuple]] = dict()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def _start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f'{self.name}-{len(self.threads)}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key: Hashable, func: Callable, *args) -> bool:
+        """
+        Queue `func(*args)` under `key`.
+        :return: `False` if the key was already waiting and only its arguments are replaced.
+        """
+        with self.lock:
+            self._start()
+            queued = key not in self.waiting
+            self.waiting[key] = (func, args)
+            if queued:
+                self.queue.put(key)
+        logging.info(f'{self.name}: `{key}` {"queued" if queued else "updated"}. ({len(self.waiting)} waiting)')
+        return queued
+
+    def _worker(self):
+        while True:
+            key = self.queue.get()
+            with self.lock:
+                func, args = self.waiting.pop(key)
+            t1 = time.time()
+            for attempt in range(self.retries + 1):
+                try:
+                    func(*args)
+                    logging.info('{}: `{}` done. take {:.2f} sec.'.format(self.name, key, time.time() - t1))
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        logging.error(f'{self.name}: `{key}` failed after {attempt + 1} tries.', e)
+                    else:
+                        logging.warning(f'{self.name}: `{key}` failed, retry. ({e})')
+                        time.sleep(self.backoff * 2 ** attempt)
+            self.queue.task_done()
+
+    def pending(self) -> int:
+        with self.lock:
+            return len(self.waiting)
@@ -0,0 +1,63 @@
+import collections
+import math
+import random
+import unittest
+from unittest import mock
+
+from sampler import SoftmaxSampler
+
+
+def softmax(weights: dict) -> dict:
+    m = max(weights.values())
+    e = {k: math.exp(v - m) for k, v in weights.items()}
+    total = math.fsum(e.values())
+    return {k: v / total for k, v in e.items()}
+
+
+class SoftmaxSamplerTest(unittest.TestCase):
+    def assert_matches(self, sampler: SoftmaxSampler, weights: dict):
+        expected = softmax(weights)
+        probabilities = sampler.probabilities()
+        self.assertAlmostEqual(math.fsum(probabilities.values()), 1, places=9)
+        for k, p in expected.items():
+            self.assertAlmostEqual(probabilities[k], p, places=9)
+        rng = random.Random(0)
+        n = 30000
+        counts = collections.Counter(sampler.sample(rng) for _ in range(n))
+        for k, p in expected.items():
+            self.assertAlmostEqual(counts[k] / n, p, delta=0.02)
+
+    def test_rated_up_then_down(self):
+        weights = {'a': 0, 'b': 0, 'c': 0}
+        sampler = SoftmaxSampler(weights)
+        for delta in [2] * 20 + [-2] * 20:
+            weights['a'] += delta
+            sampler.update('a', weights['a'])
+        self.assertAlmostEqual(sampler.total, 3 * math.exp(-sampler.shift), places=9)
+        self.assert_matches(sampler, weights)
+
+    def test_large_and_mixed_ratings(self):
+        weights = {'a': 0, 'b': 1, 'c': 2, 'd': -1, 'e': 0.5}
+        sampler = SoftmaxSampler(weights)
+        for k, v in [('a', 3), ('c', -5), ('b', 1000), ('b', -2000), ('d', 10 ** 6), ('d', 0), ('e', 4)]:
+            weights[k] = v
+            sampler.update(k, v)
+            self.assert_matches(sampler, weights)
+
+    def test_rating_does_not_rebuild(self):
+        weights = {k: 0 for k in 'abcdefghij'}
+        sampler = SoftmaxSampler(weights)
+        with mock.patch.object(sampler, '_build', wraps=sampler._build) as build:
+            for k in 'abcdefghij':
+                for delta in [-1, -1, 1, -1, 1, 1]:
+                    weights[k] += delta
+                    sampler.update(k, weights[k])
+            build.assert_not_called()
+        self.assert_matches(sampler, weights)
+
+    def test_empty(self):
+        self.assertIsNone(SoftmaxSampler().sample())
+
+
+if __name__ == '__main__':
+    unittest.main()
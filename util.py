@@ -1,25 +1,39 @@
+import ast
+import atexit
 import base64
+import concurrent.futures
 import copy
-import gc
 import io
 import json
 import logging
+import mimetypes
 import os
+import re
+import subprocess
+import threading
 import time
-from typing import Union
+from typing import TYPE_CHECKING, Dict, Iterator, Optional, Union
 
+import httpx
 import numpy as np
 import openai
 import requests
-import torch.cuda
-import torchaudio
-import whisper
-from PIL import Image
-from audiocraft.data.audio import audio_write
-from audiocraft.models import MusicGen
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image, ImageOps
+
+import cache
+import models
+import sampler
+import tasks
+from config_store import ConfigStore
+
+if TYPE_CHECKING:
+    import torch
 
 CONFIG_FILE = './config.json'
 DEFAULT_CONFIG_FILE = './default_config.json'
+CONFIG_JOURNAL_FILE = './config.journal'
 VOICE_PROMPT = './VOICE_PROMPT.wav'
 IMG_INPUT = './IMAGE_INPUT.png'
 IMG_OUTPUT = './static/IMAGE_OUTPUT.png'
@@ -27,11 +41,22 @@ IMG_OUTPUT_PREVIEW = './static/IMAGE_OUTPUT_PREVIEW.png'
 BGM_OUTPUT = './static/BGM_OUTPUT.wav'
 RANDOM_PROMPT_STYLE = 'random'
 ANALYSIS_RESULT = './analysis_result.png'
+STYLE_EXAMPLE_DIR = './static/style_example/'
 
 PORT = 5000
 
 
-DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+WHISPER_SAMPLE_RATE = 16000
+
+DEVICE: Optional[str] = None
+
+# format -> (ffmpeg codec, ffmpeg container, file extension, extra ffmpeg args)
+AUDIO_FORMATS = {
+    'wav': (None, None, '.wav', []),
+    'mp3': ('libmp3lame', 'mp3', '.mp3', []),
+    'opus': ('libopus', 'ogg', '.ogg', []),
+    'aac': ('aac', 'ipod', '.m4a', ['-movflags', 'frag_keyframe+empty_moov']),
+}
 
 IMAGE_GENERATE_API = {
     'sd': ['sd', 'stable diffusion', 'stable_diffusion'],
@@ -39,48 +64,627 @@ IMAGE_GENERATE_API = {
 }
 
 logging.info('Load config...')
-config = dict()
-try:
-    with open(CONFIG_FILE, 'r') as f:
-        config = json.loads(f.read())
-except FileNotFoundError:
-    with open(DEFAULT_CONFIG_FILE, 'r') as f:
-        config = json.loads(f.read())
-        with open(CONFIG_FILE, 'w') as ff:
-            ff.write(f.read())
-
-logging.info('Load MusicGen model...')
-music_model = MusicGen.get_pretrained(config['music_model'], DEVICE)
-music_model.set_generation_params(duration=int(config['BGM_duration']))
-
-logging.info('Load whisper model...')
-whisper_model = whisper.load_model(config['whisper_model'], DEVICE)
+config_store = ConfigStore(CONFIG_FILE, DEFAULT_CONFIG_FILE, CONFIG_JOURNAL_FILE)
+# the latest read-only config snapshot, rebound whenever config changes
+config = config_store.snapshot()
+def _on_config_publish(snapshot):
+    global config
+    config = snapshot
+config_store.listeners.append(_on_config_publish)
+
+# samples `random` prompt style by softmax of `random_weight`
+style_sampler = sampler.SoftmaxSampler()
+_sampled_styles = None
+def _sync_style_sampler(snapshot):
+    """
+    Keep `style_sampler` in sync with config. Snapshots share unchanged styles, so only styles which aren't the same
+    object as last time are updated, and the sampler is only rebuilt when styles are added or removed.
+    """
+    global _sampled_styles
+    styles = snapshot['prompt_style']
+    if styles is _sampled_styles:
+        return
+    if _sampled_styles is None or styles.keys() != _sampled_styles.keys():
+        style_sampler.rebuild({k: v.get('random_weight', 0) for k, v in styles.items()})
+    else:
+        for k, v in styles.items():
+            if v is not _sampled_styles[k] and v.get('random_weight', 0) != _sampled_styles[k].get('random_weight', 0):
+                style_sampler.update(k, v.get('random_weight', 0))
+    _sampled_styles = styles
+_sync_style_sampler(config)
+config_store.listeners.append(_sync_style_sampler)
+config_store.flush_delay = float(config['config_store']['flush_delay'])
+config_store.fsync = bool(config['config_store']['fsync'])
+atexit.register(config_store.flush)
+
+def current_config():
+    """
+    Config snapshot pinned by the running request (see `ConfigStore.pin`), or the latest one.
+    Functions called while handling a request read config by this, so the whole request sees one config version.
+    """
+    return config_store.view()
+
+def get_device() -> str:
+    global DEVICE
+    if DEVICE is None:
+        import torch
+        DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return DEVICE
+
+def use_cpu_profile() -> bool:
+    return get_device() == 'cpu' and config['cpu_inference']['enabled']
+
+def optimize_for_cpu(module: 'torch.nn.Module', plain_linear: tuple=(), compile_modules: Optional[list]=None):
+    """
+    CPU inference profile: set intra-op threads, quantize linear layers to dynamic int8 in place, and optionally
+    `torch.compile` the forward of `compile_modules`.
+    :param plain_linear: `torch.nn.Linear` subclasses which should be quantized too. quantization only matches the
+        exact `torch.nn.Linear` type, so they are turned into plain `torch.nn.Linear` first.
+    :param compile_modules: modules whose forward will be compiled, default is `module` itself.
+    :return: the optimized module.
+    """
+    import torch
+    cpu_config = config['cpu_inference']
+    torch.set_num_threads(int(cpu_config['threads']) or os.cpu_count())
+    module.eval()
+    if cpu_config['quantize']:
+        for m in module.modules():
+            if type(m) in plain_linear:
+                m.__class__ = torch.nn.Linear
+        module = torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if cpu_config['compile']:
+        for m in compile_modules if compile_modules is not None else [module]:
+            try:
+                m.forward = torch.compile(m.forward)
+            except Exception as e:
+                logging.warning(f"Can't compile {type(m).__name__}: {e}")
+    return module
+
+def load_music_model(name: str):
+    from audiocraft.models import MusicGen
+    model = MusicGen.get_pretrained(name, get_device())
+    model.set_generation_params(duration=int(config['BGM_duration']))
+    if use_cpu_profile():
+        model.lm = optimize_for_cpu(model.lm)
+    return model
+
+def load_whisper_model(name: str):
+    import whisper
+    model = whisper.load_model(name, get_device())
+    if use_cpu_profile():
+        model = optimize_for_cpu(model, (whisper.model.Linear,), [model.encoder, model.decoder])
+    return model
+
+models.registry.register('music', load_music_model, lambda: config['music_model'])
+models.registry.register('whisper', load_whisper_model, lambda: config['whisper_model'])
+models.registry.set_budget(config['model_pool']['max_bytes'])
+
+transcript_cache = cache.Cache('transcript', max_entries=config['transcribe']['cache_max_entries'])
+
+interrogate_cache = cache.Cache('interrogate', max_entries=config['interrogate_cache']['max_entries'])
+
+gpt4_cache = cache.Cache('gpt4', max_entries=config['gpt4_cache']['max_entries'], ttl=config['gpt4_cache']['ttl'])
 
 openai.api_key = config['openai']['api_key'] if config['openai']['api_key'] is not None else os.getenv("OPENAI_API_KEY")
 logging.info('openai api key: ' + str(openai.api_key))
 
-def music_gen_pipline(prompt: str, voice: str=None):
+_client_lock = threading.Lock()
+_openai_client: Optional[openai.OpenAI] = None
+_sd_session: Optional[requests.Session] = None
+_http_session: Optional[requests.Session] = None
+
+def openai_client() -> openai.OpenAI:
+    """
+    The shared OpenAI client. It keeps connections alive between calls and is rebuilt by `reset_clients`.
+    """
+    global _openai_client
+    with _client_lock:
+        if _openai_client is None:
+            http_config = config['http_client']
+            _openai_client = openai.OpenAI(
+                api_key=openai.api_key,
+                timeout=httpx.Timeout(http_config['read_timeout'], connect=http_config['connect_timeout']),
+                max_retries=http_config['retries'],
+                http_client=httpx.Client(limits=httpx.Limits(max_connections=http_config['pool_size'],
+                                                             max_keepalive_connections=http_config['pool_size']))
+            )
+        return _openai_client
+
+def sd_post(path: str, payload: dict) -> requests.Response:
+    """
+    POST `payload` to stable diffusion webui api by the shared session, with timeout. Only connection errors and
+    502/503/504 are retried, a read timeout isn't, since webui keeps generating the first request.
+    :param path: api path, e.g. `/sdapi/v1/img2img`.
+    """
+    global _sd_session
+    http_config = config['http_client']
+    with _client_lock:
+        if _sd_session is None:
+            retry = Retry(total=http_config['retries'], read=0, backoff_factor=http_config['backoff'],
+                          status_forcelist=[502, 503, 504], allowed_methods=None, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=http_config['pool_size'], max_retries=retry)
+            _sd_session = requests.Session()
+            _sd_session.mount('http://', adapter)
+            _sd_session.mount('https://', adapter)
+        session = _sd_session
+    return session.post(url=http_config['sd_url'] + path, json=payload,
+                        timeout=(http_config['connect_timeout'], http_config['read_timeout']))
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    """
+    POST to other services (NFT server, raspberrypi) by a shared session with `http_client` timeouts. Unlike
+    `sd_post` it doesn't retry, since these requests aren't safe to repeat.
+    """
+    global _http_session
+    http_config = config['http_client']
+    with _client_lock:
+        if _http_session is None:
+            adapter = HTTPAdapter(pool_maxsize=http_config['pool_size'])
+            _http_session = requests.Session()
+            _http_session.mount('http://', adapter)
+            _http_session.mount('https://', adapter)
+        session = _http_session
+    return session.post(url, timeout=(http_config['connect_timeout'], http_config['read_timeout']), **kwargs)
+
+def reset_clients():
+    """
+    Close shared clients, so they will be rebuilt with current config on next use.
+    """
+    global _openai_client, _sd_session, _http_session
+    with _client_lock:
+        if _openai_client is not None:
+            _openai_client.close()
+        if _sd_session is not None:
+            _sd_session.close()
+        if _http_session is not None:
+            _http_session.close()
+        _openai_client, _sd_session, _http_session = None, None, None
+
+class Artifacts:
+    """
+    In-memory files of one generate request, keyed by the path constants above (e.g. `IMG_OUTPUT`).
+    Nothing is written to disk until `save`, so concurrent requests won't overwrite each other's files.
+    """
+    def __init__(self):
+        self.files: Dict[str, bytes] = dict()
+        self.file_names: Dict[str, str] = dict()
+
+    def put(self, name: str, data: bytes, file_name: Optional[str]=None):
+        """
+        :param file_name: file name to save as if it isn't the base name of `name`, e.g. BGM in another format.
+        """
+        self.files[name] = data
+        if file_name is not None:
+            self.file_names[name] = file_name
+
+    def get(self, name: str) -> Optional[bytes]:
+        return self.files.get(name)
+
+    def file_name(self, name: str) -> str:
+        return self.file_names.get(name, os.path.basename(name))
+
+    def save(self, log_path: str):
+        """
+        Write all artifacts into `log_path` by their file name.
+        """
+        for name, data in self.files.items():
+            with open(os.path.join(log_path, self.file_name(name)), 'wb') as f:
+                f.write(data)
+
+    def describe(self, name: str, log_path: str) -> dict:
+        """
+        Download url, content type and size of an artifact saved in `log_path`.
+        """
+        return {
+            'url': os.path.join(log_path, self.file_name(name))[1:],
+            'content_type': mimetypes.guess_type(self.file_name(name))[0],
+            'size': len(self.files.get(name, b''))
+        }
+
+class PreprocessedImage:
+    """
+    Decode an image once and keep its pixels, then encode each right-sized variant only once:
+    `thumbnail` for GPT4 and CLIP interrogate, `sd_init_image` for img2img.
+    """
+    def __init__(self, data: bytes):
+        self.data = data
+        image = Image.open(io.BytesIO(data))
+        self.format = image.format
+        self.image = ImageOps.exif_transpose(image).convert('RGB')
+        self.variants: Dict[tuple, str] = dict()
+        self.lock = threading.Lock()
+
+    def _encode(self, key: tuple, resize) -> str:
+        with self.lock:
+            if key not in self.variants:
+                buffer = io.BytesIO()
+                resize(self.image.copy()).save(buffer, format='png')
+                self.variants[key] = base64.b64encode(buffer.getvalue()).decode('utf8')
+            return self.variants[key]
+
+    def png(self) -> bytes:
+        """
+        Original image as png bytes. Only re-encode if it isn't png.
+        """
+        if self.format == 'PNG':
+            return self.data
+        buffer = io.BytesIO()
+        self.image.save(buffer, format='png')
+        return buffer.getvalue()
+
+    @property
+    def thumbnail(self) -> str:
+        """
+        base64 png which longest side is at most `image_preprocess.thumbnail_size`.
+        """
+        size = int(current_config()['image_preprocess']['thumbnail_size'])
+
+        def resize(image: Image.Image):
+            image.thumbnail((size, size))
+            return image
+        return self._encode(('thumbnail', size), resize)
+
+    def sd_init_image(self, width: int, height: int) -> str:
+        """
+        base64 png resized to img2img `width` x `height`.
+        """
+        return self._encode(('sd', width, height), lambda image: image.resize((width, height)))
+
+def load_audio(data: bytes, sr: int) -> np.ndarray:
+    """
+    Decode mp3 or wav bytes into mono float32 waveform by ffmpeg pipe, without writing a temp file.
+    :param data: raw audio file bytes.
+    :param sr: resample to this sample rate.
+    """
+    cmd = ['ffmpeg', '-nostdin', '-threads', '0', '-i', 'pipe:0',
+           '-f', 's16le', '-ac', '1', '-acodec', 'pcm_s16le', '-ar', str(sr), '-']
+    try:
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f'Failed to load audio: {e.stderr.decode()}') from e
+    return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
+
+def encode_audio(wav: 'torch.Tensor', sample_rate: int, fmt: str='wav', bitrate: Optional[str]=None) -> bytes:
+    """
+    Loudness normalize and compress waveform, then encode it in memory. Same normalization as
+    `audio_write(..., strategy="loudness", loudness_compressor=True)` but without the file. Compressed formats are
+    encoded by ffmpeg pipe from 16 bit pcm.
+    :param wav: [channel, time] waveform.
+    :param fmt: one of `AUDIO_FORMATS`.
+    :param bitrate: ffmpeg bitrate like `128k`, only for compressed formats.
+    """
+    from audiocraft.data.audio_utils import i16_pcm, normalize_audio
+    wav = i16_pcm(normalize_audio(wav, strategy='loudness', loudness_compressor=True, sample_rate=sample_rate))
+    codec, container, _, extra = AUDIO_FORMATS[fmt]
+    if codec is None:
+        import torchaudio
+        buffer = io.BytesIO()
+        torchaudio.save(buffer, wav, sample_rate, format='wav', encoding='PCM_S', bits_per_sample=16)
+        return buffer.getvalue()
+    cmd = ['ffmpeg', '-nostdin', '-threads', '0', '-f', 's16le', '-ar', str(sample_rate), '-ac', str(wav.shape[0]),
+           '-i', 'pipe:0', '-c:a', codec] + (['-b:a', bitrate] if bitrate else []) + extra + ['-f', container, '-']
+    try:
+        return subprocess.run(cmd, input=wav.t().contiguous().numpy().tobytes(), capture_output=True,
+                              check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f'Failed to encode audio: {e.stderr.decode()}') from e
+
+def bgm_file_name(fmt: str) -> str:
     """
-    Generate music by prompt.
+    File name of `BGM_OUTPUT` encoded in `fmt`.
+    """
+    return os.path.splitext(os.path.basename(BGM_OUTPUT))[0] + AUDIO_FORMATS[fmt][2]
+
+def trim_silence(audio: np.ndarray, sr: int, threshold_db: float, padding: float, frame: float=0.03) -> np.ndarray:
+    """
+    Energy based VAD. Cut leading and trailing frames which are `threshold_db` quieter than the loudest frame.
+    :param padding: sec of audio kept before the first and after the last voiced frame.
+    :param frame: frame length in sec.
+    :return: trimmed audio, empty if the whole audio is silence.
+    """
+    frame_size = max(int(sr * frame), 1)
+    n = len(audio) // frame_size
+    if n == 0:
+        return audio
+    rms = np.sqrt(np.mean(audio[:n * frame_size].reshape(n, frame_size) ** 2, axis=1))
+    if rms.max() <= 1e-5:
+        return audio[:0]
+    db = 20 * np.log10(np.maximum(rms, 1e-10) / rms.max())
+    voiced = np.nonzero(db > threshold_db)[0]
+    if len(voiced) == 0:
+        return audio[:0]
+    pad = int(sr * padding)
+    return audio[max(voiced[0] * frame_size - pad, 0): min((voiced[-1] + 1) * frame_size + pad, len(audio))]
+
+def transcribe(voice: bytes, variant: Optional[str]=None) -> str:
+    """
+    Translate voice into english text by whisper. Leading and trailing silence is trimmed before whisper, and
+    transcripts are cached by audio hash.
+    :param voice: mp3 or wav file bytes.
+    :param variant: whisper model name, `None` means `config['whisper_model']`.
+    """
+    transcribe_config = current_config()['transcribe']
+    variant = variant or models.registry.variant('whisper')
+    key = cache.make_key(voice, variant, transcribe_config['language'],
+                         transcribe_config['vad_threshold_db'], transcribe_config['vad_padding'])
+    text = transcript_cache.get_json(key)
+    if text is not None:
+        logging.info('Transcript cache hit.')
+        return text
+
+    audio = load_audio(voice, WHISPER_SAMPLE_RATE)
+    if transcribe_config['vad_threshold_db'] is not None:
+        length = len(audio)
+        audio = trim_silence(audio, WHISPER_SAMPLE_RATE, transcribe_config['vad_threshold_db'],
+                             transcribe_config['vad_padding'])
+        logging.info('trim silence: {:.2f} sec -> {:.2f} sec'.format(length / WHISPER_SAMPLE_RATE,
+                                                                     len(audio) / WHISPER_SAMPLE_RATE))
+    if len(audio) == 0:
+        text = ''
+    else:
+        import torch
+        with torch.inference_mode():
+            text = models.registry.get('whisper', variant).transcribe(audio, task='translate',
+                                                                      language=transcribe_config['language'],
+                                                                      fp16=get_device() != 'cpu')["text"]
+    transcript_cache.put_json(key, text)
+    return text
+
+class MusicBatcher:
+    """
+    Collect music prompts for `window` sec (or until `max_size` prompts) and generate them in one model pass.
+    Melody prompts use `generate_with_chroma`, so they are batched separately from text-only prompts, and prompts
+    with different seeds or different model objects (e.g. during model swap) are batched separately too.
+    Only one batch runs at a time, prompts arriving meanwhile are collected into the next batch.
+    `lock` is held while a batch is generating, so anything else driving the model (e.g. `music_gen_stream`) can take
+    turns with batches.
+    """
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max(max_size, 1)
+        self.cond = threading.Condition()
+        # (model, is melody, seed) -> [(prompt, melody, future)]
+        self.pending = dict()
+        self.deadline = dict()
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def generate(self, music_model, prompt: str, melody: Optional['torch.Tensor']=None,
+                 seed: Optional[int]=None) -> 'torch.Tensor':
+        """
+        Block until the batch including `prompt` is generated.
+        :param music_model: the MusicGen model to generate by.
+        :param melody: [channel, time] waveform at `music_model.sample_rate`.
+        :param seed: if not None, set torch seed before generating.
+        :return: generated [channel, time] waveform.
+        """
+        future = concurrent.futures.Future()
+        key = (music_model, melody is not None, seed)
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, name='music-batcher', daemon=True)
+                self.thread.start()
+            if key not in self.pending:
+                self.pending[key] = []
+                self.deadline[key] = time.time() + self.window
+            self.pending[key].append((prompt, melody, future))
+            self.cond.notify()
+        return future.result()
+
+    def _next_batch(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                for key in list(self.pending.keys()):
+                    if len(self.pending[key]) >= self.max_size or now >= self.deadline[key]:
+                        batch = self.pending[key][:self.max_size]
+                        self.pending[key] = self.pending[key][self.max_size:]
+                        if not self.pending[key]:
+                            self.pending.pop(key)
+                            self.deadline.pop(key)
+                        return key, batch
+                self.cond.wait(min(self.deadline.values()) - now if self.deadline else None)
+
+    def _worker(self):
+        import torch
+        while True:
+            (music_model, is_melody, seed), batch = self._next_batch()
+            prompts = [prompt for prompt, _, _ in batch]
+            logging.info(f'MusicGen batch size: {len(batch)}, melody: {is_melody}, seed: {seed}')
+            try:
+                with self.lock, torch.inference_mode():
+                    if seed is not None:
+                        torch.manual_seed(seed)
+                    if is_melody:
+                        wav = music_model.generate_with_chroma(prompts, [melody for _, melody, _ in batch],
+                                                               music_model.sample_rate, True)
+                    else:
+                        wav = music_model.generate(prompts, True)
+                for (_, _, future), w in zip(batch, wav):
+                    future.set_result(w)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+
+music_batcher = MusicBatcher(float(config['music_batch']['window']), int(config['music_batch']['max_size']))
+
+music_cache = cache.Cache('music', max_bytes=config['music_cache']['max_bytes'])
+
+melody_cache = cache.MemoryCache('melody', max_entries=config['music_cache']['melody_max_entries'])
+
+def load_melody(melody: bytes, sample_rate: int) -> 'torch.Tensor':
+    """
+    Decode and resample melody to [1, time] waveform. Waveforms are cached by audio hash, so regenerations with the
+    same melody skip decoding.
+    """
+    import torch
+    key = cache.make_key(melody, sample_rate)
+    wav = melody_cache.get(key)
+    if wav is None:
+        wav = torch.from_numpy(load_audio(melody, sample_rate))[None]
+        melody_cache.put(key, wav)
+    return wav
+
+def music_gen_pipline(prompt: str, melody: Union[bytes, 'torch.Tensor', None]=None,
+                      artifacts: Optional[Artifacts]=None, seed: Optional[int]=None, variant: Optional[str]=None):
+    """
+    Generate music by prompt. Same prompt, model, duration, melody and seed will reuse the cached BGM.
     :param prompt: the prompt generated by GPT4.
-    :return: the BGM generated by musicgen. the music will be warped by raw base64 text
+    :param melody: mp3 or wav file bytes, or [channel, time] waveform at model sample rate. only work if
+        `music_model` is a melody model.
+    :param artifacts: if not None, encoded BGM will be put into it as `BGM_OUTPUT`, named by `bgm_file_name`.
+    :param seed: torch seed for generation.
+    :param variant: MusicGen model name, `None` means `config['music_model']`.
+    :return: the BGM generated by musicgen and encoded by `audio_encode` config. the music will be warped by raw
+        base64 text
     """
+    import torch
+    config = current_config()
+    fmt, bitrate = config['audio_encode']['format'], config['audio_encode']['bitrate']
+    if fmt == 'wav':
+        bitrate = None
     logging.info('Music generation start')
     logging.info('music prompt: ' + prompt)
     t1 = time.time()
-    if voice is None or 'melody' not in config['music_model']:
-        wav = music_model.generate([prompt], True)
+    melody_key = melody.cpu().numpy().tobytes() if isinstance(melody, torch.Tensor) else melody
+    variant = variant or models.registry.variant('music')
+    key = cache.make_key(prompt, variant, int(config['BGM_duration']), melody_key if 'melody' in variant else None, seed,
+                         fmt, bitrate)
+    tmp = music_cache.get(key)
+    if tmp is not None:
+        logging.info('Music cache hit.')
     else:
-        logging.info('load ' + VOICE_PROMPT)
-        melody, sr = torchaudio.load(VOICE_PROMPT)
-        wav = music_model.generate_with_chroma([prompt], melody, sr, True)
-    audio_write(BGM_OUTPUT[:-4], wav.cpu()[0], music_model.sample_rate, strategy="loudness", loudness_compressor=True)
-    with open(BGM_OUTPUT, 'rb') as f:
-        tmp = f.read()
+        music_model, variant = models.registry.get_with_variant('music', variant)
+        if 'melody' not in variant:
+            melody = None
+            melody_key = None
+        key = cache.make_key(prompt, variant, int(config['BGM_duration']), melody_key, seed, fmt, bitrate)
+        if melody is None:
+            wav = music_batcher.generate(music_model, prompt, seed=seed)
+        else:
+            if not isinstance(melody, torch.Tensor):
+                melody = load_melody(melody, music_model.sample_rate)
+            wav = music_batcher.generate(music_model, prompt, melody, seed)
+        tmp = encode_audio(wav.cpu(), music_model.sample_rate, fmt, bitrate)
+        music_cache.put(key, tmp)
+    if artifacts is not None:
+        artifacts.put(BGM_OUTPUT, tmp, bgm_file_name(fmt))
     logging.info('Music generated done. take {:.2f} sec.'.format(time.time() - t1))
 
     return base64.b64encode(tmp).decode('utf8')
 
+def wav_stream_header(sample_rate: int, channels: int) -> bytes:
+    """
+    16 bit wav header for a stream whose length is unknown yet. Sizes are set to max, so players read until the
+    stream ends.
+    """
+    byte_rate = sample_rate * channels * 2
+    return b''.join([
+        b'RIFF', (0xFFFFFFFF).to_bytes(4, 'little'), b'WAVE',
+        b'fmt ', (16).to_bytes(4, 'little'), (1).to_bytes(2, 'little'), channels.to_bytes(2, 'little'),
+        sample_rate.to_bytes(4, 'little'), byte_rate.to_bytes(4, 'little'), (channels * 2).to_bytes(2, 'little'),
+        (16).to_bytes(2, 'little'),
+        b'data', (0xFFFFFFFF).to_bytes(4, 'little'),
+    ])
+
+class ChunkNormalizer:
+    """
+    Loudness normalization for audio which arrives chunk by chunk. Each chunk is measured on its own, but the gain is
+    smoothed over chunks so loudness doesn't jump at chunk borders, then `tanh` compresses peaks like
+    `normalize_audio(..., loudness_compressor=True)` does.
+    """
+    def __init__(self, sample_rate: int, target_lufs: float, smoothing: float, floor_lufs: float=-60):
+        self.sample_rate = sample_rate
+        self.target_lufs = target_lufs
+        self.smoothing = smoothing
+        self.floor_lufs = floor_lufs
+        self.gain_db: Optional[float] = None
+
+    def __call__(self, wav: 'torch.Tensor') -> 'torch.Tensor':
+        """
+        :param wav: [channel, time] waveform.
+        """
+        import torch
+        import torchaudio
+        lufs = float(torchaudio.functional.loudness(wav, self.sample_rate))
+        if lufs > self.floor_lufs:
+            gain_db = self.target_lufs - lufs
+            if self.gain_db is not None:
+                gain_db = self.smoothing * self.gain_db + (1 - self.smoothing) * gain_db
+            self.gain_db = gain_db
+        return torch.tanh(wav * 10 ** ((self.gain_db or 0) / 20))
+
+def music_gen_stream(prompt: str, seed: Optional[int]=None, variant: Optional[str]=None) -> Iterator[bytes]:
+    """
+    Generate music chunk by chunk and yield a 16 bit wav file as it goes: the header first, then pcm of every chunk as
+    soon as it's decoded. The first chunk is `music_stream.chunk` sec, every next chunk continues the last
+    `music_stream.context` sec of audio generated so far, until `BGM_duration` is reached.
+    The whole clip is cached as wav, so the same prompt and seed is streamed from cache next time, and
+    `music_gen_pipline` reuses it when `audio_encode.format` is wav. Melody isn't used in streaming.
+    :param prompt: music prompt.
+    :param seed: torch seed for generation.
+    :param variant: MusicGen model name, `None` means `config['music_model']`.
+    """
+    import torch
+    from audiocraft.data.audio_utils import i16_pcm
+    config = current_config()
+    stream_config = config['music_stream']
+    duration = int(config['BGM_duration'])
+    variant = variant or models.registry.variant('music')
+    key = cache.make_key(prompt, variant, duration, None, seed, 'wav', None)
+    tmp = music_cache.get(key)
+    if tmp is not None:
+        logging.info('Music cache hit.')
+        for i in range(0, len(tmp), 65536):
+            yield tmp[i: i + 65536]
+        return
+
+    logging.info('Music streaming start')
+    logging.info('music prompt: ' + prompt)
+    t1 = time.time()
+    music_model, variant = models.registry.get_with_variant('music', variant)
+    key = cache.make_key(prompt, variant, duration, None, seed, 'wav', None)
+    sample_rate = music_model.sample_rate
+    normalizer = ChunkNormalizer(sample_rate, float(stream_config['target_lufs']), float(stream_config['smoothing']))
+    chunk, context = float(stream_config['chunk']), float(stream_config['context'])
+    audio = None
+    pcm = []
+    yield wav_stream_header(sample_rate, music_model.audio_channels)
+    generated = 0
+    # leave a frame of tolerance, generated length is rounded to token frames
+    while duration - generated > 1 / music_model.frame_rate:
+        length = min(chunk, duration - generated)
+        with music_batcher.lock, torch.inference_mode():
+            if seed is not None and audio is None:
+                torch.manual_seed(seed)
+            try:
+                if audio is None:
+                    music_model.set_generation_params(duration=length)
+                    wav = music_model.generate([prompt])[0]
+                else:
+                    prompt_wav = audio[..., -int(context * sample_rate):]
+                    music_model.set_generation_params(duration=prompt_wav.shape[-1] / sample_rate + length)
+                    wav = music_model.generate_continuation(prompt_wav[None], sample_rate, [prompt])[0]
+                    wav = wav[..., prompt_wav.shape[-1]:]
+            finally:
+                music_model.set_generation_params(duration=int(config_store.snapshot()['BGM_duration']))
+        wav = wav.cpu()
+        if wav.shape[-1] == 0:
+            break
+        audio = wav if audio is None else torch.cat([audio, wav], dim=-1)
+        generated = audio.shape[-1] / sample_rate
+        data = i16_pcm(normalizer(wav)).t().contiguous().numpy().tobytes()
+        pcm.append(data)
+        logging.info('Music chunk {:.2f}/{} sec streamed. take {:.2f} sec.'.format(generated, duration, time.time() - t1))
+        yield data
+
+    import torchaudio
+    buffer = io.BytesIO()
+    pcm = torch.from_numpy(np.frombuffer(b''.join(pcm), np.int16).copy()).view(-1, music_model.audio_channels).t()
+    torchaudio.save(buffer, pcm, sample_rate, format='wav', encoding='PCM_S', bits_per_sample=16)
+    music_cache.put(key, buffer.getvalue())
+    logging.info('Music streaming done. take {:.2f} sec.'.format(time.time() - t1))
+
 def GPT4_pipline(img: str, voice_prompt: str=None):
     """
     Use GPT4 to generate img & music prompt or image's comment and description.
@@ -91,80 +695,123 @@ def GPT4_pipline(img: str, voice_prompt: str=None):
     if isinstance(img, tuple):
         return img
 
-    openai_config = copy.deepcopy(config['openai'])
-
-    if voice_prompt is not None: # use image and voice to generate prompt
-        response_message = None
-        for i in range(2):
-            logging.info(f'try times: {i}')
-            if response_message is None:
-                response = openai.OpenAI().chat.completions.create(
-                    model=openai_config['model'],
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    'type': 'text',
-                                    'text': openai_config['img_and_voice_to_prompt'].format(voice=voice_prompt)
-                                },
-                               {
-                                    'type': 'image_url',
-                                    'image_url': {
-                                        "url": f"data:image/png;base64,{img}",
-                                        'detail': 'low'
-                                    }
-                               }
-                            ]
-                        }
-                    ],
-                    max_tokens=1000
-                    # functions=openai_config['functions_prompt']
-                )
-                response_message = response.choices[0].message.content
-                logging.info('GPT4: ' + response_message)
+    openai_config = current_config()['openai']
 
+    key = cache.make_key(base64.b64decode(img), voice_prompt, openai_config['model'],
+                         openai_config['img_and_voice_to_prompt'] if voice_prompt is not None else openai_config['img_to_comment'])
+    reply = gpt4_cache.get_json(key)
+    if reply is not None:
+        logging.info('GPT4 cache hit.')
+        return reply
+    reply = _GPT4_request(img, voice_prompt, openai_config)
+    gpt4_cache.put_json(key, reply)
+    return reply
 
+def parse_prompt_json(text: Optional[str]) -> Optional[dict]:
+    """
+    Tolerant parser for GPT4 prompt reply. It strips markdown fences and surrounding text, fixes smart quotes,
+    trailing commas and truncated brackets, and finally falls back to pick `img_prompt` and `bgm_prompt` by regex.
+    :return: dict with non-empty `img_prompt` and `bgm_prompt`, or `None` if it can't be repaired.
+    """
+    if text is None:
+        return None
+
+    def check(candidate) -> Optional[dict]:
+        if isinstance(candidate, dict) and all(isinstance(candidate.get(k), str) and candidate[k].strip()
+                                               for k in ('img_prompt', 'bgm_prompt')):
+            return candidate
+        return None
+
+    text = re.sub(r'```(?:json)?', '', text).strip()
+    text = text.replace('\u201c', '"').replace('\u201d', '"').replace('\u2018', "'").replace('\u2019', "'")
+    start = text.find('{')
+    candidates = [text]
+    if start != -1:
+        body = text[start: text.rfind('}') + 1] if text.rfind('}') > start else text[start:]
+        body = re.sub(r',\s*([}\]])', r'\1', body)
+        candidates.append(body)
+        # close truncated string and brackets
+        if body.count('"') % 2 == 1:
+            body += '"'
+        candidates.append(body + '}' * (body.count('{') - body.count('}')))
+    for candidate in candidates:
+        try:
+            result = check(json.loads(candidate))
+        except json.decoder.JSONDecodeError:
             try:
-                response_message = response_message.replace('```json\n','').replace('```','')
-                tmp = json.loads(response_message)
-                check = tmp['img_prompt'] and tmp['bgm_prompt']
-                return tmp
-            except:
-                response = openai.OpenAI().chat.completions.create(
-                    model=openai_config['model'],
-                    messages=[
+                result = check(ast.literal_eval(candidate))
+            except Exception:
+                result = None
+        if result is not None:
+            return result
+
+    result = dict()
+    for k in ('img_prompt', 'bgm_prompt'):
+        # value ends at the same quote it starts with, or at the end of truncated text
+        match = re.search(r'["\']?' + k + r'["\']?\s*[:=]\s*(["\'])((?:\\.|(?!\1)[^\\])*)(?:\1|\Z)', text)
+        if match is not None:
+            result[k] = match.group(2).strip()
+    return check(result)
+
+def _GPT4_request(img: str, voice_prompt: Optional[str], openai_config: dict):
+    if voice_prompt is not None: # use image and voice to generate prompt
+        use_functions = openai_config.get('use_functions', False)
+        kwargs = dict()
+        if use_functions:
+            kwargs['tools'] = [{'type': 'function', 'function': f} for f in openai_config['functions_prompt']]
+            kwargs['tool_choice'] = {'type': 'function', 'function': {'name': openai_config['functions_prompt'][0]['name']}}
+        response = openai_client().chat.completions.create(
+            model=openai_config['model'],
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
                         {
-                            "role": "user",
-                            "content": [
-                                {
-                                    'type': 'text',
-                                    'text': openai_config['json_fix_prompt'] + response_message
-                                },
-                                {
-                                    'type': 'image_url',
-                                    'image_url': {
-                                        'url': f"data:image/png;base64,{img}",
-                                        'detail': 'low'
-                                    }
-                                }
-                            ]
-                        }
-                    ],
-                    max_tokens=1000
-                )
-                response_message = response.choices[0].message.content
-                logging.info('GPT4: ' + response_message)
-                try:
-                    tmp = json.loads(response_message)
-                    check = tmp['img_prompt'] and tmp['bgm_prompt']
-                    return tmp
-                except json.decoder.JSONDecodeError:
-                    continue
+                            'type': 'text',
+                            'text': openai_config['img_and_voice_to_prompt'].format(voice=voice_prompt)
+                        },
+                       {
+                            'type': 'image_url',
+                            'image_url': {
+                                "url": f"data:image/png;base64,{img}",
+                                'detail': 'low'
+                            }
+                       }
+                    ]
+                }
+            ],
+            max_tokens=1000,
+            **kwargs
+        )
+        message = response.choices[0].message
+        response_message = message.tool_calls[0].function.arguments if message.tool_calls else message.content
+        logging.info('GPT4: ' + str(response_message))
 
+        for i in range(2):
+            tmp = parse_prompt_json(response_message)
+            if tmp is not None:
+                return tmp
+            # the image isn't needed to fix json, so only send text
+            logging.info(f'GPT4 reply is not legal json, ask GPT4 to fix it. try times: {i}')
+            response = openai_client().chat.completions.create(
+                model=openai_config['model'],
+                messages=[
+                    {
+                        "role": "user",
+                        "content": openai_config['json_fix_prompt'] + str(response_message)
+                    }
+                ],
+                max_tokens=1000
+            )
+            response_message = response.choices[0].message.content
+            logging.info('GPT4: ' + str(response_message))
+
+        tmp = parse_prompt_json(response_message)
+        if tmp is not None:
+            return tmp
         raise RuntimeError(f"GPT4 didn't generate legal prompt. prompt: {response_message}")
     else: # give img comment
-        response_message = openai.OpenAI().chat.completions.create(
+        response_message = openai_client().chat.completions.create(
             model=openai_config['model'],
             messages=[
                 {
@@ -189,13 +836,34 @@ def GPT4_pipline(img: str, voice_prompt: str=None):
         logging.debug('GPT4: ' + response_message)
         return response_message
 
-def DALL_E_pipline(prompt: str, _img=None):
+def interrogate_pipline(image: PreprocessedImage) -> str:
+    """
+    Caption image by stable diffusion webui CLIP interrogate. Captions are cached by image content hash.
+    :param image: the input image, its thumbnail will be interrogated.
+    :return: CLIP caption.
+    """
+    key = cache.make_key(image.data, 'clip', current_config()['image_preprocess']['thumbnail_size'])
+    caption = interrogate_cache.get_json(key)
+    if caption is not None:
+        logging.info('Interrogate cache hit.')
+        return caption
+    logging.info('interrogate image prompt...')
+    t1 = time.time()
+    caption = sd_post('/sdapi/v1/interrogate', {
+        "image": image.thumbnail,
+        "model": "clip"
+    }).json()['caption']
+    logging.info('interrogate image prompt done. take {:.2f} sec.'.format(time.time() - t1))
+    interrogate_cache.put_json(key, caption)
+    return caption
+
+def DALL_E_pipline(prompt: str, _img=None, artifacts: Optional[Artifacts]=None):
     logging.info('dall-e prompt: ' + prompt)
 
     response = None
     try:
         t1 = time.time()
-        response = openai.OpenAI().images.generate(
+        response = openai_client().images.generate(
             model='dall-e-3',
             prompt=prompt,
             n=1,
@@ -204,56 +872,84 @@ def DALL_E_pipline(prompt: str, _img=None):
         )
 
         logging.info('Image generated done. take {:.2f} sec.'.format(time.time() - t1))
-        Image.open(io.BytesIO(base64.b64decode(response.data[0].b64_json))).save(IMG_OUTPUT)
+        if artifacts is not None:
+            artifacts.put(IMG_OUTPUT, base64.b64decode(response.data[0].b64_json))
         return response.data[0].b64_json
     except Exception as e:
         return 'dall-e error!', (response, e)
 
-def stable_diffusion_pipline(prompt: str, img: str):
+def stable_diffusion_pipline(prompt: str, img: str, artifacts: Optional[Artifacts]=None):
     """
     Generate img by sd.
     :param prompt: sd prompt.
     :param img: base img which warp by raw base64 text
+    :param artifacts: if not None, generated img will be put into it as `IMG_OUTPUT`.
     :return: generated img warp by raw base64 text
     """
     logging.info('Image generation start')
-    url = "http://127.0.0.1:7860"
-    sd_payload = copy.deepcopy(config['sd_payload'])
-    sd_payload['prompt'] = sd_payload['prompt'] + prompt
-    sd_payload['init_images'] = [img]
+    sd_payload = current_config()['sd_payload']
+    sd_payload = {**sd_payload, 'prompt': sd_payload['prompt'] + prompt, 'init_images': [img]}
     logging.info('sd prompt: ' + sd_payload['prompt'])
 
     t1 = time.time()
-    response = requests.post(url=f'{url}/sdapi/v1/img2img', json=sd_payload)
+    response = sd_post('/sdapi/v1/img2img', sd_payload)
 
 
     if response.status_code == 200:
         r = response.json()
         logging.info('Image generated done. take {:.2f} sec.'.format(time.time() - t1))
-        Image.open(io.BytesIO(base64.b64decode(r['images'][0]))).save(IMG_OUTPUT)
+        if artifacts is not None:
+            artifacts.put(IMG_OUTPUT, base64.b64decode(r['images'][0]))
 
         return r['images'][0]
     else:
         return 'stable diffusion error!', response
 
+def style_example_path(style: str, ext: str='.jpg') -> str:
+    return STYLE_EXAMPLE_DIR + f'{style}{ext}'.replace(' ', '_').replace('-', '_')
+
+def find_style_example(style: str) -> Optional[str]:
+    """
+    Path of the example image of `style`, examples saved by older versions as full size png are found too.
+    :return: `None` if the style doesn't have example.
+    """
+    for ext in ('.jpg', '.png'):
+        if os.path.isfile(style_example_path(style, ext)):
+            return style_example_path(style, ext)
+    return None
+
+def generate_style_example(style: str, image_prompt: str):
+    """
+    Generate example image of a prompt style by DALL-E, and save it as a jpeg thumbnail which longest side is at
+    most `style_example.size`.
+    """
+    example_config = config['style_example']
+    generated = DALL_E_pipline(image_prompt)
+    if isinstance(generated, tuple):
+        raise RuntimeError(generated[0], generated[1][1])
+    img = Image.open(io.BytesIO(base64.b64decode(generated))).convert('RGB')
+    img.thumbnail((int(example_config['size']), int(example_config['size'])))
+    path = style_example_path(style)
+    img.save(path + '.tmp', format='jpeg', quality=int(example_config['quality']), optimize=True)
+    os.replace(path + '.tmp', path)
+
+style_example_queue = tasks.BackgroundQueue('style-example', retries=int(config['style_example']['retries']),
+                                            backoff=float(config['style_example']['backoff']))
+
 def load_config():
-    global config
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            config = json.loads(f.read())
-    except FileNotFoundError:
-        with open(DEFAULT_CONFIG_FILE, 'r') as f:
-            config = json.loads(f.read())
-            with open(CONFIG_FILE, 'w') as ff:
-                ff.write(f.read())
+    """
+    Reload `config.json`. Unsaved changes are flushed first, so they won't be lost.
+    """
+    config_store.flush()
+    config_store.load()
+    reset_clients()
 
 def save_config(key: Union[str, dict, None]=None, value=None):
     """
-    save config and reload model if necessary
+    Update config and reload model if necessary. `config.json` is written in background, see `ConfigStore`.
     :param key: `dict` or `str`. `dict` will update config by `dict`, `str` will update config by key-value pair
     :param value: only work if `key` is `str`
     """
-    global music_model, whisper_model
     tmp_dict = dict()
     if key is not None:
         if isinstance(key, str):
@@ -265,30 +961,30 @@ def save_config(key: Union[str, dict, None]=None, value=None):
                 if k == 'prompt_style':
                     if RANDOM_PROMPT_STYLE in v.keys():
                         v.pop(RANDOM_PROMPT_STYLE)
-                    for vk in v.keys():
-                        if v[vk].get('image_prompt') is not None:
-                            def generate_example_img():
-                                img = Image.open(io.BytesIO(base64.b64decode(DALL_E_pipline(v[vk].get('image_prompt')))))
-                                img.resize((img.size[0]//2, img.size[1]//2))
-                                img.save(f'./static/style_example/{vk}.png'.replace(' ', '_').replace('-', '_'))
-                            try:
-                                generate_example_img()
-                            except:
-                                try:
-                                    generate_example_img()
-                                except:
-                                    pass
-
-                        if v[vk].get('random_weight') is None:
-                            v[vk]['random_weight'] = 0
-                config[k].update(v)
-            else:
-                config[k] = v
     else:
         key = ''
 
-    with open(CONFIG_FILE, 'w') as f:
-        f.write(json.dumps(config, indent=2))
+    def apply(state: dict):
+        for k, v in tmp_dict.items():
+            if isinstance(v, dict):
+                if k == 'prompt_style':
+                    # merge into the existing style, so styles can be built step by step
+                    for vk in v.keys():
+                        style = state[k].setdefault(vk, dict())
+                        style.update(v[vk])
+                        if style.get('random_weight') is None:
+                            style['random_weight'] = 0
+                else:
+                    state[k].update(v)
+            else:
+                state[k] = v
+    config_store.update(apply, tmp_dict.keys())
+
+    # example images are generated in background, so editing a style returns immediately
+    if isinstance(tmp_dict.get('prompt_style'), dict):
+        for style, style_config in tmp_dict['prompt_style'].items():
+            if style_config.get('image_prompt') is not None:
+                style_example_queue.submit(style, generate_style_example, style, style_config['image_prompt'])
 
     if isinstance(key, dict):
         key = key.keys()
@@ -296,22 +992,26 @@ def save_config(key: Union[str, dict, None]=None, value=None):
         key = [key]
 
     if 'music_model' in key:
-        music_model = MusicGen.get_pretrained(config['music_model'], DEVICE)
-        gc.collect()
-        torch.cuda.empty_cache()
+        models.registry.swap('music')
 
     if 'BGM_duration' in key:
-        music_model.set_generation_params(duration=int(config['BGM_duration']))
+        for music_model in models.registry.loaded('music'):
+            music_model.set_generation_params(duration=int(config['BGM_duration']))
 
     if 'whisper_model' in key:
-        whisper_model = whisper.load_model(config['whisper_model'], DEVICE)
-        gc.collect()
-        torch.cuda.empty_cache()
+        models.registry.swap('whisper')
+
+    if 'model_pool' in key:
+        models.registry.set_budget(config['model_pool']['max_bytes'])
 
     if 'openai' in key and tmp_dict.get('openai', dict()).get('api_key', False):
         openai.api_key = config['openai']['api_key']
+        reset_clients()
+
+    if 'http_client' in key:
+        reset_clients()
 
 def softmax(x) -> np.ndarray:
     y = np.exp(x - np.max(x))
-    f_x = y / np.sum(np.exp(x))
+    f_x = y / np.sum(y)
     return f_x
\ No newline at end of file